@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+executor = ThreadPoolExecutor(max_workers=4)
+
+timings = dict()
+timings_lock = threading.Lock()
+directory_listings = dict()
+
+
+class AssetDict(dict):
+    def __init__(self, load):
+        super().__init__()
+        self.load = load
+
+    def __missing__(self, key):
+        self.load(key)
+        if key not in self:
+            raise KeyError(key)
+        return dict.get(self, key)
+
+
+def timed(category, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, category, time.perf_counter() - start
+
+
+def submit(category, function, *args):
+    # the time is recorded as soon as the work is done, whether or not its result is ever used
+    future = executor.submit(timed, category, function, *args)
+    future.add_done_callback(record_future)
+    return future
+
+
+def record_future(future):
+    if not future.cancelled() and future.exception() is None:
+        record(*future.result()[1:])
+
+
+def record(category, seconds):
+    with timings_lock:
+        total, count = timings.get(category, (0.0, 0))
+        timings[category] = (total + seconds, count + 1)
+
+
+def report():
+    lines = ['Asset loading:']
+    for category, (total, count) in sorted(timings.items()):
+        lines.append(f'  {category:<16} {count:4d} files {1000 * total:8.1f} ms')
+    return '\n'.join(lines)
+
+
+def list_directory(*path):
+    path = os.path.join(*path)
+    if path not in directory_listings:
+        directory_listings[path] = [x.split('.')[0] for x in os.listdir(path)]
+
+    return list(directory_listings[path])
@@ -77,6 +77,7 @@ class Slider(GameObject):
         self.left_arrow = None
         self.right_arrow = None
         self.visible = True
+        self.arrow_position = None
 
     def set_visible(self, visible):
         self.visible = visible
@@ -117,13 +118,6 @@ class Slider(GameObject):
         self.text.visible = self.visible
         self.value_text.visible = self.visible
 
-        self.text.draw(batch, camera, image_handler)
-        self.value_text.draw(batch, camera, image_handler)
-        self.left_arrow = camera.draw_sprite(image_handler, 'left', self.position - 2 * basis(0), 0.7,
-                                             batch=batch, sprite=self.left_arrow)
-        self.right_arrow = camera.draw_sprite(image_handler, 'right', self.position + 2 * basis(0), 0.7,
-                                              batch=batch, sprite=self.right_arrow)
-
         if self.visible:
             color = self.color_selected if self.selected else self.color
 
@@ -133,17 +127,29 @@ class Slider(GameObject):
             val_str = str(self.values[self.selection]).replace(', ', 'x').strip('()')
             self.value_text.string = val_str
 
-        if self.left_arrow:
-            if not self.visible or not self.selected or (not self.cyclic and self.selection == 0):
-                self.left_arrow.visible = False
-            else:
-                self.left_arrow.visible = True
+        self.text.draw(batch, camera, image_handler)
+        self.value_text.draw(batch, camera, image_handler)
 
-        if self.right_arrow:
-            if not self.visible or not self.selected or (not self.cyclic and self.selection == len(self.values) - 1):
-                self.right_arrow.visible = False
-            else:
-                self.right_arrow.visible = True
+        if self.left_arrow is None or camera.moved or self.arrow_position != tuple(self.position):
+            self.left_arrow = camera.draw_sprite(image_handler, 'left', self.position - 2 * basis(0), 0.7,
+                                                 batch=batch, sprite=self.left_arrow)
+            self.right_arrow = camera.draw_sprite(image_handler, 'right', self.position + 2 * basis(0), 0.7,
+                                                  batch=batch, sprite=self.right_arrow)
+            self.arrow_position = tuple(self.position)
+
+        if not self.visible or not self.selected or (not self.cyclic and self.selection == 0):
+            visible = False
+        else:
+            visible = True
+        if self.left_arrow.visible != visible:
+            self.left_arrow.visible = visible
+
+        if not self.visible or not self.selected or (not self.cyclic and self.selection == len(self.values) - 1):
+            visible = False
+        else:
+            visible = True
+        if self.right_arrow.visible != visible:
+            self.right_arrow.visible = visible
 
     def randomize(self):
         self.selection = np.random.randint(len(self.values))
@@ -2,6 +2,7 @@ from itertools import chain
 
 import numpy as np
 import pyglet
+from numpy.linalg import norm
 from PIL import Image
 from pyglet.gl import *
 
@@ -27,7 +28,86 @@ from helpers import basis, rotate, norm2
 # 15: text, icons
 
 
-UNIT_CIRCLE = [np.zeros(2)] + [np.array([np.cos(theta), np.sin(theta)]) for theta in np.linspace(0, 2 * np.pi, 20)]
+UNIT_CIRCLE = np.vstack((np.zeros(2), np.column_stack((np.cos(np.linspace(0, 2 * np.pi, 20)),
+                                                        np.sin(np.linspace(0, 2 * np.pi, 20))))))
+
+
+class LabelGroup(pyglet.graphics.Group):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.x = 0
+        self.y = 0
+        self.scale = 1.0
+
+    def set_state(self):
+        glPushMatrix()
+        glTranslatef(self.x, self.y, 0)
+        glScalef(self.scale, self.scale, 1)
+
+    def unset_state(self):
+        glPopMatrix()
+
+
+class QuadBatch:
+    def __init__(self):
+        self.queue = {}
+        self.vertex_lists = {}
+
+    def add(self, image, positions, angles, scale_x, scale_y, color, opacity, group):
+        texture = image.get_texture()
+        key = (texture.id, group)
+        if key not in self.queue:
+            self.queue[key] = (texture, [])
+        self.queue[key][1].append((texture, positions, angles, scale_x, scale_y, color, opacity))
+
+    def draw(self, batch):
+        for key in list(self.vertex_lists):
+            if key not in self.queue:
+                self.vertex_lists.pop(key)[0].delete()
+
+        for key, (owner, items) in self.queue.items():
+            n = sum(len(i[1]) for i in items)
+
+            vertex_list, capacity = self.vertex_lists.get(key, (None, 0))
+            if n > capacity:
+                if vertex_list:
+                    vertex_list.delete()
+                capacity = 2 ** int(np.ceil(np.log2(max(n, 16))))
+                group = pyglet.sprite.SpriteGroup(owner, GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA, key[1])
+                vertex_list = batch.add(4 * capacity, GL_QUADS, group, 'v2f/stream', 'c4B/stream', 't3f/stream')
+                self.vertex_lists[key] = (vertex_list, capacity)
+
+            vertices = np.zeros((capacity, 4, 2), dtype=np.float32)
+            colors = np.zeros((capacity, 4, 4), dtype=np.uint8)
+            tex_coords = np.zeros((capacity, 4, 3), dtype=np.float32)
+
+            i = 0
+            for texture, positions, angles, scale_x, scale_y, color, opacity in items:
+                m = len(positions)
+                x1 = -texture.anchor_x * scale_x
+                y1 = -texture.anchor_y * scale_y
+                x2 = x1 + texture.width * scale_x
+                y2 = y1 + texture.height * scale_y
+
+                corners = np.stack([np.column_stack((x1, y1)), np.column_stack((x2, y1)),
+                                    np.column_stack((x2, y2)), np.column_stack((x1, y2))], axis=1)
+
+                cos = np.cos(angles)[:, np.newaxis]
+                sin = np.sin(angles)[:, np.newaxis]
+                vertices[i:i + m, :, 0] = positions[:, np.newaxis, 0] + corners[:, :, 0] * cos - corners[:, :, 1] * sin
+                vertices[i:i + m, :, 1] = positions[:, np.newaxis, 1] + corners[:, :, 0] * sin + corners[:, :, 1] * cos
+
+                colors[i:i + m, :, :3] = color
+                colors[i:i + m, :, 3] = opacity[:, np.newaxis]
+                tex_coords[i:i + m] = np.reshape(texture.tex_coords, (4, 3))
+
+                i += m
+
+            np.ctypeslib.as_array(vertex_list.vertices)[:] = vertices.ravel()
+            np.ctypeslib.as_array(vertex_list.colors)[:] = colors.ravel()
+            np.ctypeslib.as_array(vertex_list.tex_coords)[:] = tex_coords.ravel()
+
+        self.queue.clear()
 
 
 class Camera:
@@ -42,6 +122,12 @@ class Camera:
         self.shake_velocity = np.zeros(2)
         self.velocity = np.zeros(2)
         self.layers = [pyglet.graphics.OrderedGroup(i) for i in range(16)]
+        self.quad_batch = QuadBatch()
+        self.shadows = {}
+        self.polygon_indices = {}
+
+        self.view = None
+        self.moved = True
 
         self.sprite = None
         self.target_position = self.position.copy()
@@ -131,14 +217,37 @@ class Camera:
         self.half_width = 0.5 * self.resolution[0] / self.zoom * basis(0)
         self.half_height = 0.5 * self.resolution[1] / self.zoom * basis(1)
 
+    def update_view(self):
+        view = (*self.position, self.zoom, *self.shake, *self.resolution)
+        self.moved = view != self.view
+        self.view = view
+
     def set_zoom(self, zoom):
         self.zoom = zoom
         self.half_width = 0.5 * self.resolution[0] / self.zoom * basis(0)
         self.half_height = 0.5 * self.resolution[1] / self.zoom * basis(1)
 
+    def is_visible(self, position, radius=0.0):
+        delta = np.abs(np.asarray(position) - self.position)
+        return (delta[..., 0] <= self.half_width[0] + radius) & (delta[..., 1] <= self.half_height[1] + radius)
+
+    def cull_sprite(self, image_handler, image_path, position, scale, sprite):
+        image = image_handler.images[image_path]
+        if self.is_visible(position, 0.01 * abs(scale) * max(image.width, image.height)):
+            return False
+
+        if sprite and sprite.visible:
+            sprite.visible = False
+            sprite.culled = True
+
+        return True
+
     def world_to_screen(self, position):
         return np.array((position - self.position) * self.zoom + 0.5 * self.resolution + self.shake, dtype=int)
 
+    def world_to_screen_many(self, positions):
+        return ((np.asarray(positions) - self.position) * self.zoom + 0.5 * self.resolution + self.shake).astype(int)
+
     def screen_to_world(self, position):
         return (np.array(position, dtype=float) - 0.5 * self.resolution - self.shake) / self.zoom + self.position
 
@@ -146,34 +255,102 @@ class Camera:
                     scale_y=None, batch=None, layer=1, sprite=None):
         if sprite is None:
             sprite = pyglet.sprite.Sprite(img=image_handler.images[image_path], batch=batch, group=self.layers[layer])
+            sprite.image_path = image_path
+            sprite.transform = None
+            sprite.culled = False
 
-        sprite.image = image_handler.images[image_path]
+        if sprite.image_path != image_path:
+            sprite.image = image_handler.images[image_path]
+            sprite.image_path = image_path
 
-        if scale_x:
+        if scale_x is not None:
             scale_x = direction * self.zoom * scale_x / 100
             scale_y = self.zoom * scale_y / 100
         else:
             scale_x = direction * self.zoom * scale / 100
             scale_y = self.zoom * scale / 100
-        sprite.update(*self.world_to_screen(position), -np.rad2deg(angle), scale_x=scale_x, scale_y=scale_y)
-        sprite.group = self.layers[layer]
+
+        transform = (*self.world_to_screen(position), -np.rad2deg(angle), scale_x, scale_y)
+        if transform != sprite.transform:
+            sprite.update(*transform[:3], scale_x=scale_x, scale_y=scale_y)
+            sprite.transform = transform
+
+        if sprite.group is not self.layers[layer]:
+            sprite.group = self.layers[layer]
+
+        if sprite.culled:
+            sprite.visible = True
+            sprite.culled = False
 
         return sprite
 
+    def draw_particles(self, image_handler, image_path, positions, angles, scale_x, scale_y, opacity=255, layer=13,
+                       color=(255, 255, 255)):
+        self.add_quads(image_handler.images[image_path], positions, angles, scale_x, scale_y, opacity, layer, color)
+
+    def add_quads(self, image, positions, angles, scale_x, scale_y, opacity=255, layer=13, color=(255, 255, 255)):
+        n = len(positions)
+        angles = np.broadcast_to(angles, n)
+        scale_x = np.broadcast_to(scale_x, n)
+        scale_y = np.broadcast_to(scale_y, n)
+        opacity = np.broadcast_to(opacity, n)
+
+        radius = 0.01 * max(image.width, image.height) * np.maximum(np.abs(scale_x), np.abs(scale_y))
+        visible = self.is_visible(positions, radius)
+        if not visible.any():
+            return
+
+        positions = (positions[visible] - self.position) * self.zoom + 0.5 * self.resolution + self.shake
+        self.quad_batch.add(image, positions, angles[visible], self.zoom * scale_x[visible] / 100,
+                            self.zoom * scale_y[visible] / 100, color, opacity[visible].astype(int),
+                            self.layers[layer])
+
+    def draw_shadow(self, image_handler, image_path, position, light_position, offset, scale_x, scale_y, angle):
+        if image_path not in self.shadows:
+            self.shadows[image_path] = (image_handler.images[image_path], [])
+        self.shadows[image_path][1].append((*position, *light_position, *offset, scale_x, scale_y, angle))
+
+    def draw_quads(self, batch):
+        # shadows are offset away from the light by half a unit, computed for all of them at once
+        for image, shadows in self.shadows.values():
+            shadows = np.array(shadows)
+            r = shadows[:, 0:2] - shadows[:, 2:4]
+
+            # like normalized, an object exactly at the light is not offset
+            lengths = norm(r, axis=1)
+            lengths[lengths == 0] = 1
+            positions = shadows[:, 0:2] + 0.5 * r / lengths[:, np.newaxis] + shadows[:, 4:6]
+            self.add_quads(image, positions, shadows[:, 8], shadows[:, 6], shadows[:, 7], 128, 2, (0, 0, 0))
+        self.shadows.clear()
+
+        self.quad_batch.draw(batch)
+
     def draw_label(self, string, position, size, font=None, color=(255, 255, 255), batch=None, layer=6, label=None):
+        # glyphs are laid out at a quantized font size and scaled to the exact size by the label's group, so zooming
+        # and moving the camera do not relayout the text
+        font_size = size * self.zoom
+        if font_size > 0:
+            quantized = 2 ** (np.round(4 * np.log2(font_size)) / 4)
+        else:
+            quantized = label.font_size if label else 1
+
         if not label:
             font = 'Roboto' if font is None else font
-            label = pyglet.text.Label(string, font_name=font, font_size=size*self.zoom,
-                                      anchor_x='center', anchor_y='center', color=color + (255,),
-                                      batch=batch, group=self.layers[layer])
-
-        label.text = string
-        label.color = color + (255,)
-        x, y = self.world_to_screen(position)
-        label.x = x
-        label.y = y
-        if size * self.zoom != label.font_size:
-            label.font_size = size * self.zoom
+            group = LabelGroup(self.layers[layer])
+            label = pyglet.text.Label(string, font_name=font, font_size=quantized, anchor_x='center',
+                                      anchor_y='center', color=color + (255,), batch=batch, group=group)
+            label.transform_group = group
+
+        if label.text != string:
+            label.text = string
+        if tuple(label.color[:3]) != tuple(color):
+            label.color = color + (255,)
+        if label.font_size != quantized:
+            label.font_size = quantized
+
+        group = label.transform_group
+        group.x, group.y = self.world_to_screen(position).tolist()
+        group.scale = font_size / quantized
 
         return label
 
@@ -196,55 +373,57 @@ class Camera:
 
     def draw_polygon(self, points, color=(255, 255, 255), batch=None, layer=1, vertex_list=None, linewidth=0):
         if linewidth != 0:
-            return self.draw_line(points + [points[0]], linewidth, color, batch, layer, vertex_list)
+            return self.draw_line(np.concatenate((points, points[:1])), linewidth, color, batch, layer, vertex_list)
 
-        vertices = [self.world_to_screen(p)[i] for p in points for i in range(2)]
-        colors = [int(c) for c in color] * len(points)
+        vertices = self.world_to_screen_many(points).ravel()
+        n = len(points)
+        colors = np.tile(np.array(color, dtype=int), n)
 
         if batch is None:
-            pyglet.graphics.draw(len(points), pyglet.gl.GL_TRIANGLES, ('v2i', vertices), ('c3B', colors))
+            pyglet.graphics.draw(n, pyglet.gl.GL_TRIANGLES, ('v2i', vertices), ('c3B', colors))
             return
 
-        # no idea what this does
-        # https://codereview.stackexchange.com/questions/90921/drawing-circles-with-triangles
-        index = list(chain.from_iterable((0, x - 1, x) for x in range(2, len(points))))
-
         if vertex_list is None:
-            return batch.add_indexed(len(points), pyglet.gl.GL_TRIANGLES, self.layers[layer],
-                                     index, ('v2i', vertices), ('c3B', colors))
-        else:
-            vertex_list.vertices = vertices
-            vertex_list.colors = colors
-            return vertex_list
+            if n not in self.polygon_indices:
+                # triangle fan around the first point
+                # https://codereview.stackexchange.com/questions/90921/drawing-circles-with-triangles
+                self.polygon_indices[n] = list(chain.from_iterable((0, x - 1, x) for x in range(2, n)))
+
+            vertex_list = batch.add_indexed(n, pyglet.gl.GL_TRIANGLES, self.layers[layer],
+                                            self.polygon_indices[n], 'v2i', 'c3B')
+
+        np.ctypeslib.as_array(vertex_list.vertices)[:] = vertices
+        np.ctypeslib.as_array(vertex_list.colors)[:] = colors
+        return vertex_list
 
     def draw_circle(self, position, radius, color=(255, 255, 255), batch=None, layer=1, vertex_list=None, linewidth=0):
-        points = [radius * x + position for x in UNIT_CIRCLE]
+        points = radius * UNIT_CIRCLE + position
         return self.draw_polygon(points, color, batch=batch, layer=layer, vertex_list=vertex_list, linewidth=linewidth)
 
     def draw_ellipse(self, position, width, height, angle=0.0, color=(255, 255, 255), batch=None, layer=1, vertex_list=None):
         if width == height:
             return self.draw_circle(position, width, color, batch, layer, vertex_list)
 
-        points = [position]
-        points += [rotate(np.array([width * np.cos(theta), height * np.sin(theta)]), angle) + position
-                   for theta in np.linspace(0, 2 * np.pi, 8)]
+        theta = np.linspace(0, 2 * np.pi, 8)
+        points = np.column_stack((width * np.cos(theta), height * np.sin(theta)))
+        c, s = np.cos(angle), np.sin(angle)
+        points = np.vstack((np.zeros(2), points @ np.array([[c, s], [-s, c]]))) + position
         return self.draw_polygon(points, color, batch=batch, layer=layer, vertex_list=vertex_list)
-        
+
     def draw_line(self, points, linewidth=1, color=(255, 255, 255), batch=None, layer=1, vertex_list=None):
         pyglet.gl.glLineWidth(linewidth * self.zoom)
 
-        points = [points[0]] + [p for p in points[1:-1] for _ in range(2)] + [points[-1]]
-        vertices = [self.world_to_screen(p)[i] for p in points for i in range(2)]
-        n = int(len(vertices) / 2)
-        colors = [int(c) for c in color] * n
-        
+        vertices = self.world_to_screen_many(np.repeat(points, 2, axis=0)[1:-1]).ravel()
+        n = len(vertices) // 2
+        colors = np.tile(np.array(color, dtype=int), n)
+
         if batch is None:
             pyglet.graphics.draw(n, pyglet.gl.GL_LINES, ('v2i', vertices), ('c3B', colors))
             return
 
         if vertex_list is None:
-            return batch.add(n, pyglet.gl.GL_LINES, self.layers[layer], ('v2i', vertices), ('c3B', colors))
-        else:
-            vertex_list.vertices = vertices
-            vertex_list.colors = colors
-            return vertex_list
+            vertex_list = batch.add(n, pyglet.gl.GL_LINES, self.layers[layer], 'v2i', 'c3B')
+
+        np.ctypeslib.as_array(vertex_list.vertices)[:] = vertices
+        np.ctypeslib.as_array(vertex_list.colors)[:] = colors
+        return vertex_list
@@ -139,6 +139,23 @@ def overlap_rectangle_circle(hw1, w1, hh1, h1, p1, r2, p2):
     return np.zeros(2)
 
 
+def colliders_in_area(colliders, position, half_width, half_height):
+    found = set()
+    if not colliders:
+        return found
+
+    left = max(int((position[0] - half_width) / GRID_SIZE), 0)
+    right = min(int((position[0] + half_width + 1) / GRID_SIZE), len(colliders))
+    bottom = max(int((position[1] - half_height) / GRID_SIZE), 0)
+    top = min(int((position[1] + half_height + 1) / GRID_SIZE), len(colliders[0]))
+
+    for i in range(left, right):
+        for j in range(bottom, top):
+            found.update(colliders[i][j])
+
+    return found
+
+
 class Collision:
     def __init__(self, collider, overlap):
         self.collider = collider
@@ -331,6 +348,10 @@ class Rectangle(Collider):
         return np.zeros(2)
 
     def point_inside(self, point):
+        if not self.half_width[1] and not self.half_height[0]:
+            return abs(point[0] - self.position[0]) < abs(self.half_width[0]) \
+                and abs(point[1] - self.position[1]) < abs(self.half_height[1])
+
         m = 2 * np.array([self.half_width, self.half_height]).T
 
         r = point - self.position + self.half_width + self.half_height
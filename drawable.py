@@ -1,6 +1,5 @@
 import numpy as np
 from PIL import Image
-from numpy.linalg import norm
 
 from helpers import rotate, normalized
 
@@ -15,7 +14,18 @@ class Decal:
         self.layer = layer
         self.image_position = np.zeros(2)
 
+    def delete(self):
+        if self.sprite:
+            self.sprite.delete()
+            self.sprite = None
+
     def draw(self, batch, camera, image_handler):
+        if self.sprite and not camera.moved:
+            return
+
+        if camera.cull_sprite(image_handler, self.image_path, self.position, self.size, self.sprite):
+            return
+
         self.sprite = camera.draw_sprite(image_handler, self.image_path, self.position, self.size, angle=self.angle,
                                          batch=batch, layer=self.layer, sprite=self.sprite)
 
@@ -41,15 +51,7 @@ class Drawable(Decal):
         super().__init__(position, image_path, size, angle, layer)
         self.direction = 1
         self.angle = angle
-        self.shadow_sprite = None
-
-    def delete(self):
-        if self.sprite:
-            self.sprite.delete()
-            self.sprite = None
-        if self.shadow_sprite:
-            self.shadow_sprite.delete()
-            self.shadow_sprite = None
+        self.stretch = 1.0
 
     def rotate(self, delta_angle):
         self.angle += delta_angle
@@ -63,17 +65,17 @@ class Drawable(Decal):
             return
 
         pos = self.position + rotate(self.image_position, self.angle)
+        if camera.cull_sprite(image_handler, self.image_path, pos, max(self.stretch, 1.0) * self.size, self.sprite):
+            return
+
         self.sprite = camera.draw_sprite(image_handler, self.image_path, pos, self.size, self.direction, self.angle,
-                                         batch=batch, layer=self.layer, sprite=self.sprite)
+                                         scale_x=self.stretch * self.size, scale_y=self.size, batch=batch,
+                                         layer=self.layer, sprite=self.sprite)
 
     def draw_shadow(self, batch, camera, image_handler, light):
         if not self.image_path:
             return
 
-        r = self.position - light.position
-        pos = self.position + 0.5 * r / norm(r) + rotate(self.image_position, self.angle)
-
-        self.shadow_sprite = camera.draw_sprite(image_handler, self.image_path, pos, self.size, self.direction,
-                                                self.angle, batch=batch, layer=2, sprite=self.shadow_sprite)
-        self.shadow_sprite.color = (0, 0, 0)
-        self.shadow_sprite.opacity = 128
+        camera.draw_shadow(image_handler, self.image_path, self.position, light.position,
+                           rotate(self.image_position, self.angle), self.direction * self.stretch * self.size,
+                           self.size, self.angle)
@@ -1,6 +1,5 @@
 import math
 import os
-import pickle
 
 import numpy as np
 import pyglet
@@ -9,6 +8,7 @@ from pyglet.window import key
 from pyglet.window import mouse
 
 from imagehandler import ImageHandler
+import levelfile
 from optionhandler import OptionHandler
 from camera import Camera
 from goal import Exit, Basket, Goal
@@ -59,13 +59,11 @@ class Editor(pyglet.window.Window):
         if symbol == key.S:
             for i, o in enumerate(self.level.objects.values()):
                 o.id = i
-            with open(self.path + '.pickle', 'wb') as f:
-                pickle.dump(self.level.get_data(), f)
+            levelfile.write(self.path + '.level', self.level.get_data())
         elif symbol == key.L:
-            with open(self.path + '.pickle', 'rb') as f:
-                data = pickle.load(f)
-                self.level.clear()
-                self.level.apply_data(data)
+            data = levelfile.read(self.path + '.level')
+            self.level.clear()
+            self.level.apply_data(data)
         elif symbol == key.DELETE:
             self.level.clear()
         elif symbol == key.SPACE:
@@ -182,16 +180,19 @@ class Editor(pyglet.window.Window):
 
     def on_draw(self):
         self.clear()
+        self.camera.update_view()
         self.draw_grid(1.0)
         self.level.draw(self.batch, self.camera, self.image_handler)
 
         for g in self.level.goals:
             g.draw(self.batch, self.camera, self.image_handler)
-            g.sprite.color = (0, 0, 255) if g.team == 'blue' else (255, 0, 0)
+            if g.sprite:
+                g.sprite.color = (0, 0, 255) if g.team == 'blue' else (255, 0, 0)
 
         for p in self.level.player_spawns:
             p.draw(self.batch, self.camera, self.image_handler)
-            p.sprite.color = (0, 0, 255) if p.team == 'blue' else (255, 0, 0)
+            if p.sprite:
+                p.sprite.color = (0, 0, 255) if p.team == 'blue' else (255, 0, 0)
 
         self.draw_selection()
 
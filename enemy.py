@@ -1,20 +1,13 @@
-import os
 from enum import Enum
 
 import numpy as np
 
+from assets import list_directory
 from collider import Circle, Group, GRID_SIZE
 from helpers import normalized, norm2, basis
 from player import Player
 from weapon import Weapon, Axe
 
-path = os.path.join('data', 'images', 'heads')
-HEADS = [x.split('.')[0] for x in os.listdir(path)]
-
-path = os.path.join('data', 'images', 'bodies')
-BODIES = [x.split('.')[0] for x in os.listdir(path)]
-
-
 class EnemyState(Enum):
     IDLE = 1
     SEEK_WEAPON = 2
@@ -28,8 +21,8 @@ class Enemy(Player):
     def __init__(self, position):
         super().__init__(position, controller_id=-1)
         self.goal = None
-        self.body_type = np.random.choice(BODIES)
-        self.head_type = np.random.choice(HEADS)
+        self.body_type = np.random.choice(list_directory('data', 'images', 'bodies'))
+        self.head_type = np.random.choice(list_directory('data', 'images', 'heads'))
         self.state = EnemyState.IDLE
         self.vision_collider = Circle(self.position, 0.25)
         self.ai_timer = 0
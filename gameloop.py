@@ -1,4 +1,5 @@
 import os
+import time
 from _thread import *
 
 import numpy as np
@@ -12,8 +13,10 @@ from helpers import basis
 from level import Level
 from menu import State, PlayerMenu, MainMenu, OptionsMenu, PauseMenu, LevelMenu, ControlsMenu, CampaignMenu, CreditsMenu
 from player import Player
-from network import Network
+from network import Network, UdpNetwork
 from prop import Ball
+import protocol
+from rollback import Rollback
 from text import Text
 from weapon import Bullet
 
@@ -46,6 +49,9 @@ class GameLoop:
 
         self.network = None
         self.network_id = -1
+        self.rollback = None
+        self.deltas = None
+        self.controller_data = None
         self.obj_id = -1
 
         self.controller = None
@@ -150,7 +156,7 @@ class GameLoop:
                         self.players[len(self.players)] = player
 
             if self.delay_timer > 0:
-                if self.level.background:
+                if self.level.loaded:
                     self.delay_timer -= time_step
                     if not self.text.string:
                         self.text.string = 'DECEASED'
@@ -197,7 +203,7 @@ class GameLoop:
                 self.camera.set_position_zoom(0.5 * np.array([self.level.width, self.level.height]), zoom)
 
             if self.delay_timer > 0:
-                if self.level.background:
+                if self.level.loaded:
                     self.delay_timer -= time_step
                     if not self.text.string:
                         self.text.string = 'GET READY'
@@ -335,7 +341,7 @@ class GameLoop:
             if self.network is None:
                 self.menu.set_visible(False)
 
-                self.network = Network()
+                self.network = UdpNetwork(self.controller.get_data()) if self.option_handler.udp else Network()
                 data = self.network.data
 
                 if data is None:
@@ -344,13 +350,18 @@ class GameLoop:
                     self.state = State.MENU
                     return
 
-                self.network_id = data[0][0]
-
-                self.add_player(self.controller_id, self.network_id)
-                self.players[self.network_id].apply_data(data[0])
+                message, data = data
+                rollback = message == protocol.ROLLBACK_WELCOME
+                if rollback:
+                    self.network_id, seed, level_data = data
+                else:
+                    player_data, level_data = data
+                    self.network_id = player_data[0]
+                    self.add_player(self.controller_id, self.network_id)
+                    self.players[self.network_id].apply_data(player_data)
 
                 self.level = Level()
-                self.level.apply_data(data[1])
+                self.level.apply_data(level_data)
 
                 self.colliders = [[[] for _ in range(int(self.level.height))] for _ in range(int(self.level.width))]
 
@@ -363,20 +374,49 @@ class GameLoop:
                 for obj in self.level.objects.values():
                     obj.collider.update_occupied_squares(self.colliders)
 
-                start_new_thread(self.network_thread, ())
+                if rollback:
+                    self.rollback = Rollback(self.level, self.players, self.colliders, self.network_id, seed)
+                    start_new_thread(self.rollback_thread, ())
+                else:
+                    self.deltas = protocol.DeltaDecoder()
+                    self.controller_data = self.controller.get_data()
+                    start_new_thread(self.network_thread, ())
+
+            if self.rollback:
+                if not self.rollback.running:
+                    # the session starts once a second player has joined, every client builds the same world
+                    roster = self.rollback.roster
+                    if len(roster) < 2:
+                        return
 
-            for i in list(self.level.objects.keys()):
-                obj = self.level.objects[i]
-                if isinstance(obj, Destroyable):
-                    if obj.destroyed:
-                        obj.update(self.level.gravity, self.time_scale * time_step, self.colliders)
-                        if not obj.debris:
-                            del self.level.objects[i]
-                elif isinstance(obj, Bullet):
-                    if obj.destroyed:
-                        obj.update(self.level.gravity, self.time_scale * time_step, self.colliders)
-                        if obj.destroyed and not obj.particle_clouds:
-                            del self.level.objects[i]
+                    for p in self.players.values():
+                        p.delete()
+                    self.players.clear()
+
+                    for i, k in enumerate(roster):
+                        self.add_player(self.controller_id if k == self.network_id else -1, k)
+                        self.players[k].team = ['blue', 'red'][i % 2]
+                        self.players[k].set_spawn(self.level, self.players)
+
+                    self.rollback.start()
+
+                self.rollback.update(self.controller.get_data(), time_step)
+            else:
+                self.controller_data = self.controller.get_data()
+                self.apply_state()
+
+                for i in list(self.level.objects.keys()):
+                    obj = self.level.objects[i]
+                    if isinstance(obj, Destroyable):
+                        if obj.destroyed:
+                            obj.update(self.level.gravity, self.time_scale * time_step, self.colliders)
+                            if not obj.debris:
+                                del self.level.objects[i]
+                    elif isinstance(obj, Bullet):
+                        if obj.destroyed:
+                            obj.update(self.level.gravity, self.time_scale * time_step, self.colliders)
+                            if obj.destroyed and not obj.particle_clouds:
+                                del self.level.objects[i]
 
             self.camera.target_position[:] = self.players[self.network_id].position
         elif self.state is State.OPTIONS:
@@ -491,7 +531,7 @@ class GameLoop:
         elif self.state is State.LEVEL_SELECT:
             self.level_menu.input(input_handler)
         elif self.state is State.LAN:
-            if self.network is not None:
+            if self.network_id in self.players:
                 player = self.players[self.network_id]
 
                 input_handler.relative_mouse[:] = input_handler.mouse_position - player.shoulder
@@ -509,12 +549,15 @@ class GameLoop:
             self.credits_menu.input(input_handler)
 
     def draw(self, batch, image_handler):
+        self.camera.update_view()
         self.text.draw(batch, self.camera, image_handler)
         if self.state in {State.SINGLEPLAYER, State.MULTIPLAYER, State.LAN}:
             image_handler.set_clear_color((113, 118, 131))
 
             if self.level:
-                self.level.draw(batch, self.camera, image_handler)
+                # lan clients without rollback get positions from the server and do not keep the grid up to date
+                colliders = None if self.network and not self.rollback else self.colliders
+                self.level.draw(batch, self.camera, image_handler, colliders)
                 if self.option_handler.shadows:
                     self.level.draw_shadow(batch, self.camera, image_handler)
 
@@ -556,6 +599,8 @@ class GameLoop:
             if State.CREDITS in state_queue:
                 self.credits_menu.draw(batch, self.camera, image_handler)
 
+        if self.state is not State.PAUSED:
+            self.camera.draw_quads(batch)
         self.camera.draw(batch)
 
         if self.state is State.PAUSED:
@@ -586,7 +631,7 @@ class GameLoop:
 
             if self.level:
                 sound_handler.menu_player.pause()
-                if self.level.background:
+                if self.level.loaded:
                     sound_handler.music_player.play()
                 self.level.play_sounds(sound_handler)
         elif self.state is State.OPTIONS:
@@ -608,38 +653,64 @@ class GameLoop:
         self.campaign_menu.play_sounds(sound_handler)
         self.credits_menu.play_sounds(sound_handler)
 
-    def network_thread(self):
+    def rollback_thread(self):
         while True:
-            data = self.controller.get_data()
+            data = self.network.send(protocol.rollback_inputs(self.rollback.get_outgoing()))
+            if data is not None:
+                self.rollback.receive(*data)
+            time.sleep(0.5 * self.rollback.time_step)
 
-            data = self.network.send(data)
+    def apply_state(self):
+        players, removed_players, objects, removed_objects = self.deltas.take()
 
-            for p in data[0]:
-                if p[0] not in self.players:
-                    self.add_player(-1, p[0])
+        for p in players:
+            if p[0] not in self.players:
+                self.add_player(-1, p[0])
 
-                self.players[p[0]].apply_data(p)
+            self.players[p[0]].apply_data(p)
 
-            # kinda purkka
-            ids = [p[0] for p in data[0]]
-            for k in list(self.players.keys()):
-                if k != self.network_id and k not in ids:
-                    del self.players[k]
+        for k in removed_players:
+            if k != self.network_id and k in self.players:
+                del self.players[k]
 
-            for d in data[1]:
-                if d[0] in self.level.objects:
-                    self.level.objects[d[0]].apply_data(d)
-                else:
-                    obj = d[1]([d[2], d[3]])
-                    obj.apply_data(d)
-                    self.level.objects[d[0]] = obj
-                    self.colliders[obj.collider.group].append(obj.collider)
+        for d in objects:
+            if d[0] in self.level.objects:
+                self.level.objects[d[0]].apply_data(d)
+            else:
+                obj = d[1]([d[2], d[3]])
+                obj.apply_data(d)
+                self.level.objects[d[0]] = obj
+                self.colliders[obj.collider.group].append(obj.collider)
 
-            ids = [o[0] for o in data[1]]
-            for i in list(self.level.objects):
+        for i in removed_objects:
+            if i in self.level.objects:
                 obj = self.level.objects[i]
-                if i not in ids:
-                    if isinstance(obj, Destroyable):
-                        obj.destroy(self.colliders)
-                    elif isinstance(obj, Bullet):
-                        obj.destroy()
+                if isinstance(obj, Destroyable):
+                    obj.destroy(self.colliders)
+                elif isinstance(obj, Bullet):
+                    obj.destroy()
+
+        for message, data in self.network.take_events():
+            if message == protocol.JOIN:
+                if data not in self.players:
+                    self.add_player(-1, data)
+            elif message == protocol.LEAVE:
+                if data != self.network_id and data in self.players:
+                    del self.players[data]
+            elif message == protocol.KILL:
+                if data in self.players:
+                    self.players[data].destroy(self.colliders)
+            elif message == protocol.SCORE:
+                for goal, score in zip(self.level.goals, data):
+                    goal.score = score
+                    if self.level.scoreboard:
+                        self.level.scoreboard.scores[goal.team] = score
+
+    def network_thread(self):
+        # only decodes states, they are applied on the main thread between updates
+        while True:
+            delta = self.network.send(protocol.controller_input(self.controller_data, self.deltas.ack))
+            if delta is None:
+                break
+
+            self.deltas.apply(delta)
@@ -357,9 +357,6 @@ class Destroyable(PhysicsObject):
     def draw_shadow(self, screen, camera, image_handler, light):
         if not self.destroyed:
             super().draw_shadow(screen, camera, image_handler, light)
-        elif self.shadow_sprite:
-            self.shadow_sprite.delete()
-            self.shadow_sprite = None
 
     def debug_draw(self, screen, camera, image_handler):
         super().debug_draw(screen, camera, image_handler)
@@ -44,3 +44,18 @@ def polar_angle(v):
 
 def polar_to_cartesian(r, theta):
     return r * np.array([np.cos(theta), np.sin(theta)])
+
+
+def paste(image, source, mask, position):
+    x, y = position
+    x0 = max(x, 0)
+    y0 = max(y, 0)
+    x1 = min(x + source.shape[1], image.shape[1])
+    y1 = min(y + source.shape[0], image.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    source = source[y0 - y:y1 - y, x0 - x:x1 - x]
+    mask = mask[y0 - y:y1 - y, x0 - x:x1 - x]
+    region = image[y0:y1, x0:x1]
+    region[:] = region * (1 - mask) + source * mask + 0.5
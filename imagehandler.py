@@ -1,26 +1,81 @@
 import os
+import time
 
 from PIL import Image, ImageOps
 
 import numpy as np
 import pyglet
 from pyglet.gl import *
+from pyglet.image.atlas import TextureBin, AllocatorException
+
+from assets import AssetDict, submit, record
+
+
+BODY_PARTS = ['body', 'foot', 'lower_leg', 'upper_leg', 'lower_arm', 'upper_arm']
+
+
+def decode_image(path):
+    image = Image.open(path).convert('RGBA').transpose(Image.FLIP_TOP_BOTTOM)
+    return np.asarray(image)
+
+
+def decode_decal(path):
+    return ImageOps.mirror(Image.open(path))
+
+
+def decode_tiles(path):
+    name = os.path.basename(path).replace('.png', '')
+    image = ImageOps.mirror(Image.open(path))
+    if 'vertical' in name:
+        return image_to_tiles(image, 1, 3)
+    elif 'horizontal' in name or name == 'platform':
+        return image_to_tiles(image, 3, 1)
+    else:
+        return image_to_tiles(image, 3, 3)
+
+
+def image_to_tiles(image, nx, ny):
+    width = image.width
+    height = image.height
+    tile_width = width // nx
+
+    if ny == 3:
+        ys = [0, int(0.5 * height) - 50, int(0.5 * height) + 50, height]
+    else:
+        ys = [0, height]
+
+    tiles = []
+    for i in range(nx):
+        row = []
+        for j in range(ny):
+            tile = image.crop([i * tile_width, ys[ny - j - 1],
+                               (i + 1) * tile_width, ys[ny - j]])
+            tile = ImageOps.flip(tile)
+            row.append(tile)
+        tiles.append(row)
+
+    return tiles
 
 
 class ImageHandler:
     def __init__(self):
         self.camera = np.zeros(2)
         self.scale = 100
-        self.images = dict()
-        self.decals = dict()
-        self.tiles = dict()
+        self.images = AssetDict(self.load_image)
+        self.decals = AssetDict(self.load_decal)
+        self.tiles = AssetDict(self.load_tiles)
+        self.prepared_tiles = dict()
+        self.atlas = TextureBin(2048, 2048)
         self.debug_color = (255, 0, 255)
         pyglet.resource.path = ['data/images', 'data/images/bodies', 'data/images/hands', 'data/images/heads',
                                 'data/images/weapons', 'data/images/particles', 'data/images/icons',
                                 'data/images/decals']
         pyglet.resource.reindex()
 
-        self.load_images()
+        self.files = dict()
+        self.futures = dict()
+        self.pending = []
+        self.index_images()
         # glEnable(GL_TEXTURE_2D)
         # glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
         self.load_fonts()
@@ -33,86 +88,126 @@ class ImageHandler:
     def load_fonts(self):
         path = os.path.join('data', 'fonts')
         for f in os.listdir(path):
+            start = time.perf_counter()
             pyglet.font.add_file(os.path.join(path, f))
+            record('fonts', time.perf_counter() - start)
 
-    def load_images(self):
+    def index_images(self):
         path = os.path.join('data', 'images')
 
         for r, d, f in os.walk(path):
-            if r.endswith('decals'):
-                for file in f:
-                    if file.endswith('png'):
-                        name = file.replace('.png', '')
-                        img = Image.open(os.path.join(r, file))
-                        self.decals[name] = ImageOps.mirror(img)
-            elif r.endswith('tiles'):
-                for file in f:
-                    if file.endswith('png'):
-                        name = file.replace('.png', '')
-                        img = Image.open(os.path.join(r, file))
-                        img = ImageOps.mirror(img)
-                        if 'vertical' in name:
-                            self.tiles[name] = self.image_to_tiles(img, 1, 3)
-                        elif 'horizontal' in name or name == 'platform':
-                            self.tiles[name] = self.image_to_tiles(img, 3, 1)
-                        else:
-                            self.tiles[name] = self.image_to_tiles(img, 3, 3)
-                continue
-            elif r.endswith('bodies'):
-                for file in f:
-                    if not file.endswith('png'):
-                        continue
-
-                    name = file.replace('.png', '')
-                    #image = pyglet.resource.image(file)
-                    image = pyglet.image.load(os.path.join(r, file))
-
-                    w = image.width // 2
-                    h = image.height // 5
-
-                    body = image.get_region(0, 0, w, image.height)
-                    foot = image.get_region(w, 0, w, h)
-                    lower_leg = image.get_region(w, h, w, h)
-                    upper_leg = image.get_region(w, 2 * h, w, h)
-                    lower_arm = image.get_region(w, 3 * h, w, h)
-                    upper_arm = image.get_region(w, 4 * h, w, h)
-
-                    names = ['body', 'foot', 'lower_leg', 'upper_leg', 'lower_arm', 'upper_arm']
-                    for i, img in enumerate([body, foot, lower_leg, upper_leg, lower_arm, upper_arm]):
-                        img.anchor_x = img.width // 2
-                        img.anchor_y = img.height // 2
-                        self.images[f'{names[i]}_{name}'] = img
-
-                continue
-
             for file in f:
-                if file.endswith('png'):
-                    name = file.replace('.png', '')
-
-                    #image = pyglet.resource.image(file)
-                    image = pyglet.image.load(os.path.join(r, file))
-                    image.anchor_x = image.width // 2
-                    image.anchor_y = image.height // 2
-                    self.images[name] = image
-
-    def image_to_tiles(self, image, nx, ny):
-        width = image.width
-        height = image.height
-        tile_width = width // nx
-
-        if ny == 3:
-            ys = [0, int(0.5 * height) - 50, int(0.5 * height) + 50, height]
+                if not file.endswith('png'):
+                    continue
+
+                name = file.replace('.png', '')
+                path = os.path.join(r, file)
+
+                if r.endswith('decals'):
+                    # decals are drawn as sprites too, and replace images of the same name elsewhere
+                    self.files[('decals', name)] = path
+                    self.futures[('decals', path)] = submit('decals', decode_decal, path)
+                    self.add_image(name, path)
+                elif r.endswith('tiles'):
+                    self.files[('tiles', name)] = path
+                    self.futures[('tiles', path)] = submit('tiles', decode_tiles, path)
+                elif r.endswith('bodies'):
+                    for part in BODY_PARTS:
+                        self.files[('images', f'{part}_{name}')] = path
+                    self.futures[('images', path)] = submit('bodies', decode_image, path)
+                    self.pending.append(f'body_{name}')
+                else:
+                    self.add_image(name, path)
+
+    def add_image(self, name, path):
+        if ('images', name) in self.files:
+            self.futures.pop(('images', self.files[('images', name)]), None)
+        else:
+            self.pending.append(name)
+
+        self.files[('images', name)] = path
+        self.futures[('images', path)] = submit('images', decode_image, path)
+
+    @property
+    def loaded(self):
+        return not self.pending
+
+    def update(self, time_budget=0.005):
+        # uploads images that have been decoded in the background, a few at a time
+        start = time.perf_counter()
+        while self.pending and time.perf_counter() - start < time_budget:
+            name = self.pending[0]
+            path = self.files[('images', name)]
+            if ('images', path) in self.futures and not self.futures[('images', path)].done():
+                break
+
+            self.images[name]
+            self.pending.pop(0)
+
+    def get_decoded(self, category, name):
+        path = self.files[(category, name)]
+        return path, self.futures.pop((category, path)).result()[0]
+
+    def load_image(self, name):
+        if ('images', name) not in self.files:
+            return
+
+        start = time.perf_counter()
+        path, data = self.get_decoded('images', name)
+
+        if os.path.dirname(path).endswith('bodies'):
+            sheet = os.path.basename(path).replace('.png', '')
+            h = data.shape[0] // 5
+            w = data.shape[1] // 2
+
+            regions = [data[:, 0:w], data[0:h, w:2 * w], data[h:2 * h, w:2 * w], data[2 * h:3 * h, w:2 * w],
+                       data[3 * h:4 * h, w:2 * w], data[4 * h:5 * h, w:2 * w]]
+            for part, region in zip(BODY_PARTS, regions):
+                image = self.add_to_atlas(region)
+                image.anchor_x = image.width // 2
+                image.anchor_y = image.height // 2
+                self.images[f'{part}_{sheet}'] = image
         else:
-            ys = [0, height]
-
-        tiles = []
-        for i in range(nx):
-            row = []
-            for j in range(ny):
-                tile = image.crop([i * tile_width, ys[ny - j - 1],
-                                   (i + 1) * tile_width, ys[ny - j]])
-                tile = ImageOps.flip(tile)
-                row.append(tile)
-            tiles.append(row)
-
-        return tiles
+            image = self.add_to_atlas(data)
+            image.anchor_x = image.width // 2
+            image.anchor_y = image.height // 2
+            self.images[name] = image
+
+        record('upload', time.perf_counter() - start)
+
+    def decal_path(self, name):
+        return self.files.get(('decals', name), self.files.get(('images', name)))
+
+    def load_decal(self, name):
+        if ('decals', name) in self.files:
+            self.decals[name] = self.get_decoded('decals', name)[1]
+        elif ('images', name) in self.files:
+            self.decals[name] = decode_decal(self.files[('images', name)])
+
+    def load_tiles(self, name):
+        if ('tiles', name) in self.files:
+            self.tiles[name] = self.get_decoded('tiles', name)[1]
+
+    def add_to_atlas(self, data):
+        # one pixel of transparent padding keeps neighbouring images from bleeding in when scaled
+        height, width = data.shape[:2]
+        padded = np.pad(data, ((1, 1), (1, 1), (0, 0)))
+        padded = pyglet.image.ImageData(width + 2, height + 2, 'RGBA', padded.tobytes())
+
+        try:
+            return self.atlas.add(padded).get_region(1, 1, width, height)
+        except AllocatorException:
+            return pyglet.image.ImageData(width, height, 'RGBA', np.ascontiguousarray(data).tobytes()).get_texture()
+
+    def get_tile(self, path, n, m):
+        key = (path, n, m)
+        if key not in self.prepared_tiles:
+            tile = self.tiles[path][n][m]
+            tile = tile.resize([int(1.05 * s) for s in tile.size], Image.ANTIALIAS).convert('RGBA')
+            tile = np.asarray(tile, dtype=np.float32)
+            mask = tile[:, :, 3:] / 255
+            shadow = np.zeros_like(tile)
+            shadow[:, :, 3] = 128
+            self.prepared_tiles[key] = (tile, mask, shadow)
+
+        return self.prepared_tiles[key]
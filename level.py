@@ -1,19 +1,25 @@
 import os
-import pickle
 
 import numpy as np
 import pyglet
 from PIL import Image
 
-from collider import Rectangle
+from collider import Rectangle, colliders_in_area
 from drawable import Decal
 from gameobject import GameObject, Destroyable
 from goal import Basket
 from helpers import basis
 from prop import Crate
+import assets
+import levelfile
+import texturecache
 from wall import Wall, Platform, Scoreboard
 from weapon import Gun, Bullet, Grenade
 
+# decals only change how the level looks, they draw from their own generator so that the simulation keeps the global
+# one to itself and comes out the same on every client
+cosmetic = np.random.RandomState()
+
 
 class Level:
     def __init__(self, path='', server=False, editor=False):
@@ -27,7 +33,15 @@ class Level:
         self.scoreboard = None
         self.background = None
         self.walls_sprite = None
+        self.walls_future = None
         self.decals = []
+        self.baking_decals = []
+        self.max_decals = 32
+        self.visible_objects = set()
+        self.drawn_objects = []
+
+        # objects the collider grid can not find, kept up to date by update
+        self.unindexed = set()
 
         self.gravity = np.array([0, -25.0])
         self.id_count = 0
@@ -35,6 +49,14 @@ class Level:
         self.server = server
         self.editor = editor
 
+        # with rollback objects are removed as soon as the simulation is done with them, the level takes over their
+        # particle clouds, which are saved with the snapshots, and their decals, which are added once per object id
+        # however often a frame is simulated again
+        self.rollback = False
+        self.particle_clouds = []
+        self.pending_decals = dict()
+        self.decal_ids = set()
+
         self.width = 0.0
         self.height = 0.0
         self.position = np.zeros(2)
@@ -42,9 +64,9 @@ class Level:
         self.light = None
         self.dust = True
 
+        self.object_templates = ()
         if self.path:
-            with open(os.path.join('data', 'levels', self.path) + '.pickle', 'rb') as f:
-                self.apply_data(pickle.load(f))
+            self.apply_data(levelfile.load(os.path.join('data', 'levels', self.path) + '.level'))
 
     def reset(self):
         for g in self.goals:
@@ -54,20 +76,17 @@ class Level:
         for o in self.objects.values():
             o.delete()
         self.objects.clear()
+        self.particle_clouds.clear()
 
-        if self.path:
-            with open(os.path.join('data', 'levels', self.path) + '.pickle', 'rb') as f:
-                data = pickle.load(f)
-                for o in data[2]:
-                    self.id_count += 1
-                    self.objects[o[0]] = o[1](o[2:4])
-                    self.objects[o[0]].apply_data(o)
-
-                offset = 0.5 * np.array([self.width, self.height]) - self.position
+        self.add_objects()
 
-                for o in self.objects.values():
-                    o.set_position(o.position + offset)
-                    o.dust = self.dust
+    def add_objects(self):
+        for o in self.object_templates:
+            self.id_count += 1
+            self.objects[o[0]] = o[1]([o[2], o[3]])
+            self.objects[o[0]].apply_data(o)
+            self.objects[o[0]].dust = self.dust
+            self.unindexed.add(self.objects[o[0]])
 
     def delete(self):
         for g in self.goals:
@@ -108,11 +127,6 @@ class Level:
             w = d[0]([d[1], d[2]], *d[3:])
             self.walls.append(w)
 
-        for o in data[2]:
-            self.id_count += 1
-            self.objects[o[0]] = o[1]([o[2], o[3]])
-            self.objects[o[0]].apply_data(o)
-
         for d in data[3]:
             goal = d[0]([d[1], d[2]], d[3])
             self.goals.append(goal)
@@ -130,8 +144,9 @@ class Level:
 
         self.walls.sort(key=lambda x: x.position[1])
 
-        for o in self.objects.values():
-            o.set_position(o.position + offset)
+        # objects are created already centered, here and on every reset
+        self.object_templates = tuple((o[0], o[1], o[2] + offset[0], o[3] + offset[1]) + o[4:] for o in data[2])
+        self.add_objects()
 
         for p in self.player_spawns:
             p.set_position(p.position + offset)
@@ -175,8 +190,10 @@ class Level:
         obj.id = self.id_count
         self.objects[self.id_count] = obj
         self.id_count += 1
+        self.unindexed.add(obj)
 
     def update(self, time_step, colliders):
+        unindexed = set()
         for k, obj in list(self.objects.items()):
             if not obj.grabbed:
                 obj.update(self.gravity, time_step, colliders)
@@ -195,7 +212,8 @@ class Level:
                 obj.attack()
 
             if isinstance(obj, Destroyable):
-                if obj.destroyed and (self.server or (not obj.active)):
+                if obj.destroyed and (self.server or (not obj.active) or self.rollback and not obj.debris):
+                    self.take_over(obj)
                     obj.delete()
                     del self.objects[k]
                     continue
@@ -206,51 +224,67 @@ class Level:
                         self.add_object(b)
                         b.collider.update_occupied_squares(colliders)
             elif isinstance(obj, Bullet):
-                if obj.destroyed and (self.server or not obj.particle_clouds):
+                if obj.destroyed and (self.server or self.rollback or not obj.particle_clouds):
+                    self.take_over(obj)
                     obj.collider.clear_occupied_squares(colliders)
                     obj.delete()
                     del self.objects[k]
                     continue
 
+            if obj.collider is None or obj.collider.left is None or (isinstance(obj, Bullet) or type(obj) is Grenade) and obj.decal:
+                unindexed.add(obj)
+
+        self.unindexed = unindexed
+
+        for p in self.particle_clouds:
+            p.update(self.gravity, time_step)
+        self.particle_clouds = [p for p in self.particle_clouds if p.active]
+
         if self.scoreboard:
             for g in self.goals:
                 self.scoreboard.scores[g.team] = g.score
 
-    def draw(self, batch, camera, image_handler):
+    def take_over(self, obj):
+        if not self.rollback:
+            return
+
+        self.particle_clouds.extend(obj.particle_clouds)
+        obj.particle_clouds.clear()
+
+        if (isinstance(obj, Bullet) or type(obj) is Grenade) and obj.decal:
+            self.pending_decals[obj.id] = (obj.decal, obj.position.copy())
+
+    def draw(self, batch, camera, image_handler, colliders=None):
         if not self.editor and self.width > 0 and self.height > 0:
             if self.background is None:
                 self.background = Background(self.width, self.height)
-                self.background.draw(batch, camera, image_handler)
-                self.background.add_decal(image_handler, 'light', self.light.position, scale=2)
-                for p in self.player_spawns:
-                    self.background.add_decal(image_handler, 'door', p.position + p.image_position)
-                for g in self.goals:
-                    self.background.add_decal(image_handler, g.image_path, g.position + g.image_position)
-            else:
-                self.background.draw(batch, camera, image_handler)
+                decals = [('light', tuple(self.light.position), 2)]
+                decals += [('door', tuple(p.position + p.image_position), 1.0) for p in self.player_spawns]
+                decals += [(g.image_path, tuple(g.position + g.image_position), 1.0) for g in self.goals]
+                self.background.prepare(image_handler, decals)
+            self.background.draw(batch, camera, image_handler)
 
             if self.walls_sprite is None:
                 width = int(self.width * 100)
                 height = int(self.height * 100)
-                image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-
-                for wall in self.walls:
-                    if int(wall.position[0]) == 0 or int(wall.position[0]) == self.width - 1:
-                        wall.border = True
-                    if int(wall.position[1]) == 0 or int(wall.position[1]) == self.height - 1:
-                        wall.border = True
-
-                for wall in self.walls:
-                    wall.blit_to_image(image, image_handler, self.light)
-
-                for wall in self.walls:
-                    wall.blit_to_image(image, image_handler)
-
-                image = pyglet.image.ImageData(width, height, 'RGBA', image.tobytes())
-
-                self.walls_sprite = pyglet.sprite.Sprite(img=image, x=0, y=0, batch=batch, group=camera.layers[3])
 
-            self.walls_sprite.update(*camera.world_to_screen(np.zeros(2)), scale=camera.zoom / 100)
+                if self.walls_future is None:
+                    for wall in self.walls:
+                        if int(wall.position[0]) == 0 or int(wall.position[0]) == self.width - 1:
+                            wall.border = True
+                        if int(wall.position[1]) == 0 or int(wall.position[1]) == self.height - 1:
+                            wall.border = True
+                        image_handler.tiles[wall.image_path]
+
+                    self.walls_future = assets.executor.submit(self.bake_walls, image_handler, width, height)
+                elif self.walls_future.done():
+                    image = pyglet.image.ImageData(width, height, 'RGBA', self.walls_future.result())
+
+                    self.walls_sprite = pyglet.sprite.Sprite(img=image, x=0, y=0, batch=batch,
+                                                             group=camera.layers[3])
+                    self.walls_sprite.update(*camera.world_to_screen(np.zeros(2)), scale=camera.zoom / 100)
+            elif camera.moved:
+                self.walls_sprite.update(*camera.world_to_screen(np.zeros(2)), scale=camera.zoom / 100)
         else:
             for w in self.walls:
                 w.draw(batch, camera, image_handler)
@@ -262,25 +296,92 @@ class Level:
         if self.scoreboard:
             self.scoreboard.draw(batch, camera, image_handler)
 
-        for obj in self.objects.values():
+        if colliders:
+            # only objects around the view, objects that just left it are drawn once more so that their sprites get
+            # hidden
+            visible = {c.parent for c in colliders_in_area(colliders, camera.position, camera.half_width[0] + 2,
+                                                           camera.half_height[1] + 2)}
+            objects = sorted((o for o in visible | self.visible_objects | self.unindexed
+                              if self.objects.get(getattr(o, 'id', None)) is o), key=lambda o: o.id)
+        else:
+            visible = set()
+            objects = list(self.objects.values())
+
+        self.drawn_objects.clear()
+        for obj in objects:
             if (isinstance(obj, Bullet) or type(obj) is Grenade) and obj.decal:
-                self.decals.append(Decal(obj.position, obj.decal, size=np.random.random() + 1,
-                                         angle=2*np.pi*np.random.random()))
-                obj.decal = ''
+                if self.rollback:
+                    # the decal is part of the saved state and comes back when a frame is simulated again
+                    self.pending_decals[obj.id] = (obj.decal, obj.position.copy())
+                else:
+                    self.decals.append(Decal(obj.position, obj.decal, size=cosmetic.random() + 1,
+                                             angle=2*np.pi*cosmetic.random()))
+                    obj.decal = ''
 
             obj.draw(batch, camera, image_handler)
+            self.drawn_objects.append(obj)
+
+        self.visible_objects = visible
+
+        for i, (path, position) in self.pending_decals.items():
+            if i not in self.decal_ids:
+                self.decal_ids.add(i)
+                self.decals.append(Decal(position, path, size=cosmetic.random() + 1, angle=2*np.pi*cosmetic.random()))
+        self.pending_decals.clear()
+
+        for p in self.particle_clouds:
+            p.draw(batch, camera, image_handler)
 
         for b in self.decals:
             b.draw(batch, camera, image_handler)
+        for b in self.baking_decals:
+            b.draw(batch, camera, image_handler)
+
+        # baked decals stay live until the background texture has been updated with them
+        if self.background and self.background.ready:
+            for b in self.baking_decals:
+                b.delete()
+            self.baking_decals.clear()
+
+            if len(self.decals) >= self.max_decals:
+                # the background image starts 0.05 units further than the level
+                self.background.add_decals(image_handler, [(b.image_path, b.position - 0.05, b.angle, b.size)
+                                                           for b in self.decals])
+                self.baking_decals = self.decals
+                self.decals = []
 
         if self.light:
             self.light.draw(batch, camera, image_handler)
 
+    @property
+    def loaded(self):
+        return self.background is not None and self.background.sprite is not None and self.walls_sprite is not None
+
+    def bake_walls(self, image_handler, width, height):
+        light = tuple(self.light.position) if self.light else None
+        key = texturecache.cache_key('walls', (width, height, light, [w.get_data() + (w.border,) for w in self.walls]),
+                                     os.path.join('data', 'images', 'tiles'))
+        data = texturecache.load(key, 4 * width * height)
+
+        if data is None:
+            image = np.zeros((height, width, 4), dtype=np.uint8)
+
+            for wall in self.walls:
+                wall.blit_to_image(image, image_handler, self.light)
+
+            for wall in self.walls:
+                wall.blit_to_image(image, image_handler)
+
+            data = image.tobytes()
+            texturecache.save(key, data)
+
+        return data
+
     def draw_shadow(self, screen, camera, image_handler):
         for g in self.goals:
             g.draw_shadow(screen, camera, image_handler, self.light)
 
-        for o in self.objects.values():
+        for o in self.drawn_objects:
             o.draw_shadow(screen, camera, image_handler, self.light)
 
     def debug_draw(self, screen, camera, image_handler):
@@ -331,37 +432,142 @@ class Background:
         self.layer = 0
         self.number_of_decals = 10
         self.image_changed = False
+        self.dirty_rects = []
+        self.future = None
+
+    @property
+    def ready(self):
+        return self.future is None or self.future.done()
+
+    def prepare(self, image_handler, static_decals):
+        decals = self.random_decals()
+        for path in [d[0] for d in decals + static_decals]:
+            image_handler.decals[path]
+
+        self.future = assets.executor.submit(self.paint, image_handler, decals, static_decals)
+
+    def paint(self, image_handler, decals, static_decals):
+        self.paste_decals(image_handler, decals)
+        self.add_static_decals(image_handler, static_decals)
+
+    def add_decals(self, image_handler, decals):
+        for decal in decals:
+            image_handler.decals[decal[0]]
+
+        self.future = assets.executor.submit(self.paste_decals, image_handler, decals)
+
+    def paste_decals(self, image_handler, decals):
+        for path, position, angle, scale in decals:
+            self.add_decal(image_handler, path, position, angle, scale)
 
     def draw(self, batch, camera, image_handler):
+        if self.sprite and camera.moved:
+            self.sprite.update(*camera.world_to_screen(self.position), scale=camera.zoom / 100)
+
+        # the image is painted by a worker thread and must not be read before it is done
+        if not self.ready:
+            return
+        if self.future:
+            self.future.result()
+            self.future = None
+
         if not self.sprite:
             image = pyglet.image.ImageData(*self.resolution, 'RGBA', self.image.tobytes())
             self.sprite = pyglet.sprite.Sprite(img=image, x=0, y=0, batch=batch, group=camera.layers[self.layer])
-
-            for _ in range(self.number_of_decals):
-                x = np.random.random() * self.width
-                y = np.random.random() * self.height
-                angle = 2 * np.pi * np.random.random()
-                scale = np.random.uniform(1.0, 1.5)
-                path = np.random.choice(['crack', 'crack2'])
-                self.add_decal(image_handler, path, [x, y], angle, scale)
-
-            for _ in range(self.number_of_decals):
-                x = np.random.random() * self.width
-                y = np.random.random() * self.height
-                angle = 0.5 * (np.random.random() - 0.5)
-                path = np.random.choice(['warning', 'poster', 'radioactive'])
-                self.add_decal(image_handler, path, [x, y], angle)
+            self.sprite.update(*camera.world_to_screen(self.position), scale=camera.zoom / 100)
+            self.image_changed = False
+            self.dirty_rects.clear()
 
         if self.image_changed:
-            image = pyglet.image.ImageData(*self.resolution, 'RGBA', self.image.tobytes())
-            self.sprite.image = image
+            self.dirty_rects = [(0, 0, *self.resolution)]
             self.image_changed = False
 
-        self.sprite.update(*camera.world_to_screen(self.position), scale=camera.zoom / 100)
-
-    def add_decal(self, image_handler, path, position, angle=0, scale=1.0):
+        texture = self.sprite.image
+        for rect in self.dirty_rects:
+            x0, y0, x1, y1 = rect
+            region = pyglet.image.ImageData(x1 - x0, y1 - y0, 'RGBA', self.image.crop(rect).tobytes())
+            texture.blit_into(region, x0, y0, 0)
+        self.dirty_rects.clear()
+
+    def random_decals(self):
+        decals = []
+        for _ in range(self.number_of_decals):
+            x = cosmetic.random() * self.width
+            y = cosmetic.random() * self.height
+            angle = 2 * np.pi * cosmetic.random()
+            scale = cosmetic.uniform(1.0, 1.5)
+            path = cosmetic.choice(['crack', 'crack2'])
+            decals.append((path, [x, y], angle, scale))
+
+        for _ in range(self.number_of_decals):
+            x = cosmetic.random() * self.width
+            y = cosmetic.random() * self.height
+            angle = 0.5 * (cosmetic.random() - 0.5)
+            path = cosmetic.choice(['warning', 'poster', 'radioactive'])
+            decals.append((path, [x, y], angle, 1.0))
+
+        return decals
+
+    def prepare_decal(self, image_handler, path, position, angle=0, scale=1.0):
         decal = image_handler.decals[path].rotate(-np.rad2deg(angle) + 180, expand=1)
         decal = decal.resize([int(scale * x) for x in decal.size], Image.ANTIALIAS)
         pos = [int(100 * position[0] - 0.5 * decal.width - 100), int(100 * position[1] - 0.5 * decal.height - 100)]
+        return decal, pos
+
+    def add_decal(self, image_handler, path, position, angle=0, scale=1.0):
+        decal, pos = self.prepare_decal(image_handler, path, position, angle, scale)
         self.image.paste(decal, pos, decal.convert('RGBA'))
+
+        rect = [max(pos[0], 0), max(pos[1], 0), min(pos[0] + decal.width, self.resolution[0]),
+                min(pos[1] + decal.height, self.resolution[1])]
+        if rect[0] >= rect[2] or rect[1] >= rect[3]:
+            return
+
+        # overlapping rectangles are merged so that no pixel is uploaded twice
+        merged = True
+        while merged:
+            merged = False
+            for i, r in enumerate(self.dirty_rects):
+                if r[0] < rect[2] and rect[0] < r[2] and r[1] < rect[3] and rect[1] < r[3]:
+                    rect = [min(rect[0], r[0]), min(rect[1], r[1]), max(rect[2], r[2]), max(rect[3], r[3])]
+                    del self.dirty_rects[i]
+                    merged = True
+                    break
+        self.dirty_rects.append(tuple(rect))
+
+    def add_static_decals(self, image_handler, decals):
+        # pasting with a mask is a per pixel linear blend, so any number of pastes reduces to
+        # image * factor + offset, which is what gets cached
+        width, height = self.resolution
+        paths = [image_handler.decal_path(d[0]) for d in decals]
+        paths = [os.path.dirname(p) for p in paths if p]
+        key = texturecache.cache_key('background', (self.resolution, decals), *paths)
+        data = texturecache.load(key, 5 * width * height)
+
+        if data is None:
+            offset = np.zeros((height, width, 4))
+            factor = np.ones((height, width, 1))
+
+            for path, position, scale in decals:
+                decal, pos = self.prepare_decal(image_handler, path, position, scale=scale)
+                decal = np.asarray(decal.convert('RGBA'), dtype=float)
+
+                x0, y0 = max(pos[0], 0), max(pos[1], 0)
+                x1, y1 = min(pos[0] + decal.shape[1], width), min(pos[1] + decal.shape[0], height)
+                if x0 >= x1 or y0 >= y1:
+                    continue
+
+                decal = decal[y0 - pos[1]:y1 - pos[1], x0 - pos[0]:x1 - pos[0]]
+                mask = decal[:, :, 3:] / 255
+
+                offset[y0:y1, x0:x1] = offset[y0:y1, x0:x1] * (1 - mask) + decal * mask
+                factor[y0:y1, x0:x1] *= 1 - mask
+
+            data = np.round(offset).astype(np.uint8).tobytes() + np.round(255 * factor).astype(np.uint8).tobytes()
+            texturecache.save(key, data)
+
+        offset = np.frombuffer(data, np.uint8, 4 * width * height).reshape((height, width, 4))
+        factor = np.frombuffer(data, np.uint8, offset=4 * width * height).reshape((height, width, 1)) / 255
+        image = np.asarray(self.image, dtype=float) * factor + offset
+        self.image = Image.fromarray(np.round(image).astype(np.uint8), 'RGBA')
         self.image_changed = True
@@ -0,0 +1,216 @@
+import glob
+import os
+import pickle
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from collider import Group
+from goal import Exit, Basket
+from prop import Crate, Box, Ball, Television
+from text import Tutorial
+from wall import Wall, Platform, Barrier
+from weapon import Revolver, Shotgun, SawedOff, Sniper, MachineGun, Bow, Grenade, Axe, Shield
+
+
+MAGIC = b'FBLV'
+VERSION = 1
+
+# type ids are stored in the files, so new types must only ever be appended
+TYPES = [None, Wall, Platform, Barrier, Exit, Basket, Crate, Box, Ball, Television, Revolver, Shotgun, SawedOff,
+         Sniper, MachineGun, Bow, Grenade, Axe, Shield, Tutorial]
+TYPE_IDS = {t: i for i, t in enumerate(TYPES) if t}
+
+TEAMS = ['blue', 'red']
+
+HEADER = struct.Struct('<4sHHHHHB')
+
+MAX_TEMPLATES = 8
+
+templates = OrderedDict()
+
+
+def encode_value(value):
+    if isinstance(value, Group):
+        return b'g' + struct.pack('<B', value)
+    if isinstance(value, (bool, np.bool_)):
+        return b'b' + struct.pack('<?', value)
+    if isinstance(value, (int, np.integer)):
+        return b'i' + struct.pack('<q', value)
+    if isinstance(value, (float, np.floating)):
+        return b'f' + struct.pack('<d', value)
+    if isinstance(value, str):
+        string = value.encode()
+        return b's' + struct.pack('<H', len(string)) + string
+    if isinstance(value, (set, frozenset)):
+        return b'S' + struct.pack('<H', len(value)) + b''.join(encode_value(v) for v in sorted(value))
+    if value is None:
+        return b'n'
+
+    raise ValueError(f'Cannot store {type(value).__name__} in a level file')
+
+
+def decode_value(buffer, offset):
+    tag = buffer[offset:offset + 1]
+    offset += 1
+
+    if tag == b'g':
+        return Group(buffer[offset]), offset + 1
+    if tag == b'b':
+        return bool(buffer[offset]), offset + 1
+    if tag == b'i':
+        return struct.unpack_from('<q', buffer, offset)[0], offset + 8
+    if tag == b'f':
+        return struct.unpack_from('<d', buffer, offset)[0], offset + 8
+    if tag == b's':
+        length = struct.unpack_from('<H', buffer, offset)[0]
+        offset += 2
+        return bytes(buffer[offset:offset + length]).decode(), offset + length
+    if tag == b'S':
+        length = struct.unpack_from('<H', buffer, offset)[0]
+        offset += 2
+        values = []
+        for _ in range(length):
+            value, offset = decode_value(buffer, offset)
+            values.append(value)
+        return frozenset(values), offset
+    if tag == b'n':
+        return None, offset
+
+    raise ValueError(f'Unknown value tag {tag} in level file')
+
+
+SPAWN = np.dtype([('position', '<f8', 2), ('team', 'u1')])
+WALL = np.dtype([('type', '<u2'), ('size', 'u1'), ('values', '<f8', 4)])
+GOAL = np.dtype([('type', '<u2'), ('position', '<f8', 2), ('team', 'u1')])
+OBJECT = np.dtype([('id', '<i4'), ('type', '<u2'), ('position', '<f8', 2)])
+SCOREBOARD = np.dtype([('position', '<f8', 2)])
+
+
+def write(path, data):
+    buffer = encode(data)
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(buffer)
+    os.replace(path + '.tmp', path)
+    templates.pop(path, None)
+
+
+def encode(data):
+    spawns, walls, objects, goals = data[:4]
+    scoreboard = data[4:]
+
+    chunks = [HEADER.pack(MAGIC, VERSION, len(spawns), len(walls), len(objects), len(goals), len(scoreboard))]
+
+    chunks.append(np.array([(s[0:2], TEAMS.index(s[2])) for s in spawns], dtype=SPAWN).tobytes())
+    chunks.append(np.array([(TYPE_IDS[w[0]], len(w) - 1, tuple(w[1:]) + (0.0,) * (5 - len(w))) for w in walls],
+                           dtype=WALL).tobytes())
+    chunks.append(np.array([(TYPE_IDS[g[0]], g[1:3], TEAMS.index(g[3])) for g in goals], dtype=GOAL).tobytes())
+    chunks.append(np.array([(o[0], TYPE_IDS[o[1]], o[2:4]) for o in objects], dtype=OBJECT).tobytes())
+    chunks.append(np.array([(s,) for s in scoreboard], dtype=SCOREBOARD).tobytes())
+
+    # everything after the common object fields differs per type and is stored as tagged values
+    for o in objects:
+        chunks.append(struct.pack('<B', len(o) - 4) + b''.join(encode_value(v) for v in o[4:]))
+
+    return b''.join(chunks)
+
+
+def load(path):
+    # decoded levels are immutable and shared by every Level made from the same file, the least recently used
+    # ones are dropped
+    if path in templates:
+        templates.move_to_end(path)
+        return templates[path]
+
+    data = read(path)
+    templates[path] = data
+    if len(templates) > MAX_TEMPLATES:
+        templates.popitem(last=False)
+
+    return data
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        buffer = f.read()
+
+    return decode(buffer)
+
+
+def decode(buffer):
+    magic, version, n_spawns, n_walls, n_objects, n_goals, n_scoreboards = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('Not a level file')
+    if version > VERSION:
+        raise ValueError(f'Level file version {version} is newer than supported version {VERSION}')
+
+    offset = HEADER.size
+    sections = []
+    for dtype, count in [(SPAWN, n_spawns), (WALL, n_walls), (GOAL, n_goals), (OBJECT, n_objects),
+                         (SCOREBOARD, n_scoreboards)]:
+        sections.append(np.frombuffer(buffer, dtype, count, offset).tolist())
+        offset += count * dtype.itemsize
+    spawns, walls, goals, objects, scoreboards = sections
+
+    spawns = tuple((x, y, TEAMS[team]) for (x, y), team in spawns)
+    walls = tuple((TYPES[t],) + tuple(values[:size]) for t, size, values in walls)
+    goals = tuple((TYPES[t], x, y, TEAMS[team]) for t, (x, y), team in goals)
+
+    for i, (object_id, t, (x, y)) in enumerate(objects):
+        count = buffer[offset]
+        offset += 1
+        values = []
+        for _ in range(count):
+            value, offset = decode_value(buffer, offset)
+            values.append(value)
+        objects[i] = (object_id, TYPES[t], x, y) + tuple(values)
+
+    return (spawns, walls, tuple(objects), goals) + tuple(tuple(s[0]) for s in scoreboards)
+
+
+def convert(path):
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+
+    level_path = path.replace('.pickle', '.level')
+    write(level_path, data)
+
+    if read(level_path) != data:
+        raise ValueError(f'{path} does not survive the conversion')
+
+    return level_path
+
+
+def benchmark(paths, load, repeats=100):
+    total = 0.0
+    for path in paths:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            load(path)
+        seconds = (time.perf_counter() - start) / repeats
+        total += seconds
+        print(f'  {os.path.basename(path):<20} {1e6 * seconds:8.1f} us')
+    print(f'  {"total":<20} {1e6 * total:8.1f} us')
+
+
+if __name__ == '__main__':
+    # converts the pickled levels given as arguments, then compares decoding every level file with unpickling the
+    # same data, both from memory
+    for path in sys.argv[1:]:
+        convert(path)
+
+    levels = sorted(glob.glob(os.path.join('data', 'levels', '*', '*.level')))
+    buffers = dict()
+    for path in levels:
+        with open(path, 'rb') as f:
+            buffers[path] = f.read()
+    pickles = {path: pickle.dumps(decode(buffer)) for path, buffer in buffers.items()}
+
+    print('pickle')
+    benchmark(levels, lambda path: pickle.loads(pickles[path]))
+    print('level file')
+    benchmark(levels, lambda path: decode(buffers[path]))
@@ -1,8 +1,11 @@
+import time
+
 import pygame
 import pyglet
 from pyglet.window import key
 from pyglet.gl import *
 
+import assets
 from gameloop import GameLoop
 from imagehandler import ImageHandler
 from inputhandler import InputHandler
@@ -19,6 +22,8 @@ from soundhandler import SoundHandler
 
 class GameWindow(pyglet.window.Window):
     def __init__(self):
+        self.start_time = time.perf_counter()
+        self.loading = True
         self.option_handler = OptionHandler()
         width, height = self.option_handler.resolution
         super().__init__(width, height, vsync=self.option_handler.vsync, fullscreen=self.option_handler.fullscreen)
@@ -33,9 +38,14 @@ class GameWindow(pyglet.window.Window):
 
         self.batch = pyglet.graphics.Batch()
 
+        self.max_steps = 8
+        self.accumulator = 0.0
+
         self.keys = key.KeyStateHandler()
         self.push_handlers(self.keys)
 
+        assets.record('startup', time.perf_counter() - self.start_time)
+
     def on_draw(self):
         self.clear()
         self.loop.draw(self.batch, self.image_handler)
@@ -44,9 +54,22 @@ class GameWindow(pyglet.window.Window):
             self.fps_display.draw()
 
     def update(self, dt):
+        self.image_handler.update()
+        if self.loading and self.image_handler.loaded and self.sound_handler.loaded:
+            self.loading = False
+            print(assets.report())
+            print(f'  {"total":<16} {"":10} {1000 * (time.perf_counter() - self.start_time):8.1f} ms')
+
         self.set_exclusive_mouse(self.loop.state in {State.SINGLEPLAYER, State.MULTIPLAYER, State.LAN})
-        self.loop.input(self.input_handler)
-        self.loop.update(min(dt, 0.03))
+
+        # the simulation advances in fixed steps, so a slow frame is caught up on instead of stretching a step
+        # the step follows the fps option, which can change in the options menu
+        time_step = 1.0 / self.option_handler.fps
+        self.accumulator = min(self.accumulator + dt, self.max_steps * time_step)
+        while self.accumulator >= time_step:
+            self.accumulator -= time_step
+            self.loop.input(self.input_handler)
+            self.loop.update(time_step)
         self.loop.play_sounds(self.sound_handler)
         if self.loop.state is State.OPTIONS:
             if self.loop.options_menu.options_changed:
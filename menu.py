@@ -1,9 +1,9 @@
-import os
 from enum import Enum
 import pickle
 
 import numpy as np
 
+from assets import list_directory
 from button import Button, Slider, RebindButton
 from helpers import basis
 from text import Text, TitleText
@@ -177,13 +177,11 @@ class PlayerMenu(Menu):
         self.controller_id = None
         self.button_offset = -2
 
-        path = os.path.join('data', 'images', 'heads')
-        heads = [x.split('.')[0] for x in os.listdir(path)]
+        heads = list_directory('data', 'images', 'heads')
         self.head_slider = Slider('Head', heads)
         self.buttons.append(self.head_slider)
 
-        path = os.path.join('data', 'images', 'bodies')
-        bodies = [x.split('.')[0] for x in os.listdir(path)]
+        bodies = list_directory('data', 'images', 'bodies')
         self.body_slider = Slider('Body', bodies)
         self.buttons.append(self.body_slider)
 
@@ -333,8 +331,7 @@ class PauseMenu(Menu):
 class LevelMenu(Menu):
     def __init__(self):
         super().__init__([25, -16])
-        path = os.path.join('data', 'levels', 'multiplayer')
-        levels = [x.split('.')[0] for x in os.listdir(path)]
+        levels = list_directory('data', 'levels', 'multiplayer')
         self.level_slider = Slider('Level', levels, cyclic=False)
         self.buttons.append(self.level_slider)
         self.score_slider = Slider('Score limit', range(1, 11), cyclic=False, selection=2)
@@ -356,13 +353,11 @@ class CampaignMenu(Menu):
         self.previous_state = State.MENU
         self.button_offset = -2
 
-        path = os.path.join('data', 'images', 'heads')
-        heads = [x.split('.')[0] for x in os.listdir(path)]
+        heads = list_directory('data', 'images', 'heads')
         self.head_slider = Slider('Head', heads)
         self.buttons.append(self.head_slider)
 
-        path = os.path.join('data', 'images', 'bodies')
-        bodies = [x.split('.')[0] for x in os.listdir(path)]
+        bodies = list_directory('data', 'images', 'bodies')
         self.body_slider = Slider('Body', bodies)
         self.buttons.append(self.body_slider)
 
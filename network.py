@@ -1,8 +1,193 @@
+import os
+import random
 import socket
-import pickle
+import struct
+import sys
+import threading
+import time
 
+import protocol
 
-PACKET_SIZE = 2500
+
+BUFFER_SIZE = 4096
+MAX_MESSAGE_SIZE = 1 << 24
+
+LENGTH = struct.Struct('<I')
+
+# udp packets start with their sequence number and acknowledge the latest packet received and the 32 before it
+PACKET = struct.Struct('<III')
+RELIABLE = struct.Struct('<IH')
+COUNT = struct.Struct('<B')
+MAX_PACKET_SIZE = 65507
+RELIABLE_BUDGET = 1024
+ACK_BITS = 32
+ACK_MASK = (1 << ACK_BITS) - 1
+
+RESEND_INTERVAL = 0.05
+FULL_STATE_INTERVAL = 0.1
+CONNECT_TIMEOUT = 5.0
+TIMEOUT = 5.0
+
+
+def frame(message):
+    return LENGTH.pack(len(message)) + message
+
+
+async def read_message(reader):
+    # the asyncio counterpart of Connection.receive
+    length = LENGTH.unpack(await reader.readexactly(LENGTH.size))[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise ConnectionError(f'Message of {length} bytes is too large')
+
+    return await reader.readexactly(length)
+
+
+class Connection:
+    def __init__(self, sock, size=BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def send(self, message):
+        self.sock.sendall(frame(message))
+
+    def receive(self):
+        # blocks until a whole message has arrived and returns a view of it into the receive buffer, which stays valid
+        # only until the next call
+        while True:
+            if self.start == self.end:
+                self.start = self.end = 0
+
+            available = self.end - self.start
+            if available >= LENGTH.size:
+                length = LENGTH.unpack_from(self.buffer, self.start)[0]
+                if length > MAX_MESSAGE_SIZE:
+                    raise ConnectionError(f'Message of {length} bytes is too large')
+
+                size = LENGTH.size + length
+                if available >= size:
+                    start = self.start + LENGTH.size
+                    self.start += size
+                    return self.view[start:self.start]
+            else:
+                size = LENGTH.size
+
+            self.reserve(size)
+
+            # a read may end anywhere, in the middle of the length or the message or several messages later
+            count = self.sock.recv_into(self.view[self.end:])
+            if count == 0:
+                raise ConnectionError('Connection closed')
+            self.end += count
+
+    def reserve(self, size):
+        # makes room for the next size bytes from the start of the unread data
+        if self.start + size <= len(self.buffer):
+            return
+
+        available = self.end - self.start
+        if size > len(self.buffer):
+            buffer = bytearray(max(size, 2 * len(self.buffer)))
+            buffer[:available] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.view[:available] = self.view[self.start:self.end]
+
+        self.start = 0
+        self.end = available
+
+
+class Channel:
+    # sequencing, acknowledgement and reliable ordered messages over an unreliable transport, for one peer
+    def __init__(self):
+        self.sequence = 0
+        self.remote = 0
+        self.received = 0
+
+        # reliable messages are sent in every packet until a packet carrying them is acknowledged
+        self.reliable = dict()
+        self.reliable_id = 0
+        self.expected = 0
+        self.buffered = dict()
+
+        self.sent = dict()
+        self.rtt = None
+        self.loss = 0.0
+
+    def send_reliable(self, message):
+        self.reliable[self.reliable_id] = message
+        self.reliable_id += 1
+
+    def packet(self, payload, time):
+        self.sequence += 1
+
+        ids = []
+        chunks = []
+        size = 0
+        for i, message in self.reliable.items():
+            if ids and size + len(message) > RELIABLE_BUDGET:
+                break
+            ids.append(i)
+            chunks.append(RELIABLE.pack(i, len(message)) + message)
+            size += RELIABLE.size + len(message)
+            if len(ids) == 255:
+                break
+
+        self.sent[self.sequence] = (time, ids)
+
+        return PACKET.pack(self.sequence, self.remote, self.received) + COUNT.pack(len(ids)) + b''.join(chunks) + \
+            payload
+
+    def receive(self, packet, time):
+        # returns the reliable messages that are next in order and the payload, which is dropped if a newer packet
+        # has already arrived
+        sequence, ack, bits = PACKET.unpack_from(packet)
+        offset = PACKET.size
+
+        newest = sequence > self.remote
+        if newest:
+            shift = sequence - self.remote
+            self.received = (self.received << shift | 1 << shift - 1) & ACK_MASK if self.remote else 0
+            self.remote = sequence
+        elif 0 < self.remote - sequence <= ACK_BITS:
+            self.received |= 1 << (self.remote - sequence - 1)
+
+        acked = [ack] + [ack - 1 - i for i in range(ACK_BITS) if bits >> i & 1]
+        for s in acked:
+            if s in self.sent:
+                sent_time, ids = self.sent.pop(s)
+                # includes however long the peer waited before sending the acknowledgement
+                sample = time - sent_time
+                self.rtt = sample if self.rtt is None else 0.9 * self.rtt + 0.1 * sample
+                self.loss *= 0.95
+                for i in ids:
+                    self.reliable.pop(i, None)
+
+        # packets that fall out of the acknowledgement window are lost
+        for s in [s for s in self.sent if s < ack - ACK_BITS]:
+            del self.sent[s]
+            self.loss = 0.95 * self.loss + 0.05
+
+        count = COUNT.unpack_from(packet, offset)[0]
+        offset += COUNT.size
+        for _ in range(count):
+            i, length = RELIABLE.unpack_from(packet, offset)
+            offset += RELIABLE.size
+            if i >= self.expected:
+                self.buffered[i] = bytes(packet[offset:offset + length])
+            offset += length
+
+        messages = []
+        while self.expected in self.buffered:
+            messages.append(self.buffered.pop(self.expected))
+            self.expected += 1
+
+        payload = packet[offset:] if newest and offset < len(packet) else None
+
+        return messages, payload
 
 
 class Network:
@@ -10,20 +195,217 @@ class Network:
         server = socket.gethostbyname(socket.gethostname())
         port = 5555
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connection = Connection(self.client)
         self.addr = (server, port)
         self.data = self.connect()
 
     def connect(self):
         try:
             self.client.connect(self.addr)
-            return pickle.loads(self.client.recv(5000))
-        except:
+            return protocol.decode(self.connection.receive())
+        except (socket.error, ValueError, struct.error):
             pass
 
     def send(self, data):
         try:
-            self.client.send(pickle.dumps(data))
-            reply = self.client.recv(PACKET_SIZE)
-            return pickle.loads(reply)
-        except socket.error as e:
+            self.connection.send(data)
+            return protocol.decode(self.connection.receive())[1]
+        except (socket.error, ValueError, struct.error) as e:
             print(e)
+
+    def take_events(self):
+        # the states of a stream carry everything, events only come over udp
+        return []
+
+
+class UdpNetwork:
+    def __init__(self, data):
+        server = socket.gethostbyname(socket.gethostname())
+        port = 5555
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(RESEND_INTERVAL)
+        self.channel = Channel()
+        self.addr = (server, port)
+
+        self.lock = threading.Lock()
+        self.events = []
+        self.received = time.perf_counter()
+        self.data = self.connect(data)
+
+    def connect(self, data):
+        # the server only lets in a client that sends an input, the first one is repeated until the welcome arrives
+        data = protocol.controller_input(data)
+        start = time.perf_counter()
+        while time.perf_counter() - start < CONNECT_TIMEOUT:
+            try:
+                self.client.sendto(self.channel.packet(data, time.perf_counter()), self.addr)
+                self.receive()
+            except socket.timeout:
+                continue
+            except (socket.error, ValueError, struct.error):
+                time.sleep(RESEND_INTERVAL)
+                continue
+
+            with self.lock:
+                for i, (message, data) in enumerate(self.events):
+                    if message == protocol.WELCOME:
+                        del self.events[i]
+                        return message, data
+
+    def receive(self):
+        packet = self.client.recv(MAX_PACKET_SIZE)
+        self.received = time.perf_counter()
+        messages, payload = self.channel.receive(packet, self.received)
+
+        with self.lock:
+            self.events.extend(protocol.decode(m) for m in messages)
+
+        return payload
+
+    def send(self, data):
+        # the input is sent again with the unacknowledged reliable messages until the next state arrives
+        try:
+            while True:
+                self.client.sendto(self.channel.packet(data, time.perf_counter()), self.addr)
+                try:
+                    payload = self.receive()
+                except socket.timeout:
+                    if time.perf_counter() - self.received > TIMEOUT:
+                        raise ConnectionError('Server timed out')
+                    continue
+
+                if payload is not None:
+                    return protocol.decode(payload)[1]
+        except (socket.error, ValueError, struct.error) as e:
+            print(e)
+
+    def take_events(self):
+        with self.lock:
+            events = self.events
+            self.events = []
+
+        return events
+
+
+def loopback(loss, latency, jitter, seconds=5.0, rate=60):
+    # two channels on loopback sockets, every packet is dropped or delayed on the way like on a bad wireless network
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(2)]
+    for s in sockets:
+        s.bind(('127.0.0.1', 0))
+        s.setblocking(False)
+    addresses = [s.getsockname() for s in sockets]
+    channels = [Channel(), Channel()]
+    in_flight = []
+
+    sent_events = 0
+    events = []
+    states = 0
+    start = time.perf_counter()
+    step = 0
+    while time.perf_counter() - start < seconds:
+        now = time.perf_counter()
+        if now - start >= step / rate:
+            step += 1
+            if step % 10 == 0:
+                channels[0].send_reliable(struct.pack('<I', sent_events))
+                sent_events += 1
+            for i in range(2):
+                packet = channels[i].packet(struct.pack('<I', step), now)
+                if random.random() >= loss:
+                    in_flight.append((now + latency + random.random() * jitter, i, packet))
+
+        for item in [item for item in in_flight if item[0] <= now]:
+            in_flight.remove(item)
+            _, i, packet = item
+            sockets[i].sendto(packet, addresses[1 - i])
+
+        for i in range(2):
+            try:
+                packet = sockets[i].recv(MAX_PACKET_SIZE)
+            except BlockingIOError:
+                continue
+            messages, payload = channels[i].receive(packet, now)
+            if i == 1:
+                events += [struct.unpack('<I', m)[0] for m in messages]
+                states += payload is not None
+
+        time.sleep(0.0005)
+
+    print(f'  loss {loss:4.0%} latency {1000 * latency:3.0f} ms jitter {1000 * jitter:3.0f} ms   '
+          f'states {states:4d} / {step}   events in order {events == list(range(len(events)))} '
+          f'{len(events):3d} / {sent_events}   rtt {1000 * (channels[0].rtt or 0):5.1f} ms '
+          f'loss estimate {channels[0].loss:4.0%}')
+
+
+def stream(objects, data, drop, latency=0.02, seconds=3.0, rate=30, poll=0.05):
+    # deltas of the objects sent to a client that reads every poll seconds and acknowledges the last state it
+    # applied, the packet with sequence drop is lost, on a simulated clock in steps of a millisecond
+    encoder = protocol.DeltaEncoder()
+    decoder = protocol.DeltaDecoder()
+    channels = [Channel(), Channel()]
+    to_client = []
+    to_server = []
+
+    ack = protocol.NO_BASELINE
+    full = None
+    full_states = 0
+    failures = 0
+    applied = 0
+    for step in range(round(1000 * seconds)):
+        now = step / 1000
+
+        for item in [item for item in to_server if item[0] <= now]:
+            to_server.remove(item)
+            _, payload = channels[0].receive(item[1], now)
+            if payload is not None:
+                ack = protocol.decode(payload)[1][1]
+
+        if step % round(1000 / rate) == 0:
+            for o in objects:
+                o.position[0] += 0.01
+            encoder.add([], [o.get_data() for o in objects])
+
+            interval = max(FULL_STATE_INTERVAL, 2 * (channels[0].rtt or 0))
+            base, full = encoder.baseline(ack, full, now, interval)
+            full_states += base == protocol.NO_BASELINE
+            packet = channels[0].packet(encoder.encode(base)[1], now)
+            if channels[0].sequence != drop:
+                to_client.append((now + latency, packet))
+
+        if step % round(1000 * poll) == 0:
+            for item in [item for item in to_client if item[0] <= now]:
+                to_client.remove(item)
+                _, payload = channels[1].receive(item[1], now)
+                if payload is None:
+                    continue
+
+                delta = protocol.decode(payload)[1]
+                if delta[1] != protocol.NO_BASELINE and delta[1] not in decoder.baselines:
+                    failures += 1
+                decoder.apply(delta)
+                applied += decoder.ack == delta[0]
+
+            to_server.append((now + latency, channels[1].packet(protocol.controller_input(data, decoder.ack), now)))
+
+    print(f'  lost packet {drop or "-":>3}   states {applied:3d} / {encoder.sequence}   decode failures {failures:2d}   '
+          f'full states {full_states:2d}   in sync {decoder.current == encoder.baselines.get(decoder.ack)}')
+
+
+if __name__ == '__main__':
+    # shows delivery and the estimates of a channel under different network conditions
+    conditions = [(0.0, 0.0, 0.0), (0.05, 0.02, 0.01), (0.2, 0.05, 0.05)]
+    if len(sys.argv) > 1:
+        conditions = [tuple(float(a) for a in sys.argv[1:4])]
+    for condition in conditions:
+        loopback(*condition)
+
+    # deltas recover from a single lost packet, the first one carries the full state and is sent again after a while
+    from pyglet import options
+    options['headless'] = True
+
+    from inputhandler import Controller
+    from level import Level
+
+    print('deltas after a single lost packet')
+    for drop in (0, 1, 2, 30):
+        stream(list(Level(os.path.join('multiplayer', 'circle')).objects.values()), Controller(-1).get_data(), drop)
@@ -14,6 +14,7 @@ class OptionHandler:
         self.music_volume = 100
         self.shadows = True
         self.dust = True
+        self.udp = False
 
         self.debug_draw = False
 
@@ -46,6 +47,11 @@ class OptionHandler:
         self.config.set('performance', 'shadows', str(self.shadows))
         self.config.set('performance', 'dust', str(self.dust))
 
+        if not self.config.has_section('network'):
+            self.config.add_section('network')
+
+        self.config.set('network', 'udp', str(self.udp))
+
         with open('config.ini', 'w') as f:
             self.config.write(f)
 
@@ -63,3 +69,6 @@ class OptionHandler:
 
         self.shadows = self.config.getboolean('performance', 'shadows')
         self.dust = self.config.getboolean('performance', 'dust')
+
+        # older config files have no network section
+        self.udp = self.config.getboolean('network', 'udp', fallback=False)
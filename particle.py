@@ -1,97 +1,61 @@
 import numpy as np
-from numpy.linalg import norm
 
-from helpers import polar_angle, polar_to_cartesian, norm2, random_unit, basis, rotate
+from helpers import polar_angle, polar_to_cartesian, basis
 
 
 class Cloud:
     def __init__(self, image_path, position, velocity, number, lifetime, start_size, end_size=0.0, gravity_scale=1.0,
                  base_velocity=(0, 0), stretch=0.0):
-        self.particles = []
+        self.image_path = image_path
+        self.lifetime = lifetime
+        self.start_size = start_size
+        self.end_size = end_size
+        self.gravity_scale = gravity_scale
+        self.stretch = stretch
+        self.time = 0.0
+        self.size = start_size
+        self.layer = 13
 
         self.active = True
 
         if np.any(velocity):
-            angle = polar_angle(velocity)
+            theta = np.random.normal(polar_angle(velocity), 1.0, number)
+            v_norm = np.linalg.norm(velocity)
+            r = np.abs(np.random.normal(v_norm, v_norm, number))
         else:
-            angle = None
+            theta = np.random.uniform(0, 2 * np.pi, number)
+            r = np.full(number, 5.0)
 
-        v_norm = norm(velocity)
-        for i in range(number):
-            if angle is None:
-                v = 5.0 * random_unit()
-            else:
-                theta = np.random.normal(angle, 1.0)
-                r = np.abs(np.random.normal(v_norm, v_norm))
-                v = polar_to_cartesian(r, theta)
-
-            self.particles.append(Particle(image_path, position, base_velocity + v, lifetime=lifetime,
-                                           start_size=start_size, end_size=end_size,
-                                           gravity_scale=gravity_scale, stretch=stretch))
+        self.initial_position = np.array(position, dtype=float)
+        self.initial_velocity = np.array(base_velocity, dtype=float) + r[:, np.newaxis] * np.column_stack(
+            (np.cos(theta), np.sin(theta)))
+        self.position = np.tile(self.initial_position, (number, 1))
+        self.velocity = self.initial_velocity.copy()
 
     def update(self, gravity, time_step):
-        for p in self.particles:
-            p.update(gravity, time_step)
-
-            if p.time >= p.lifetime:
-                p.delete()
-                self.particles.remove(p)
+        self.time = min(self.time + time_step, self.lifetime)
+        if self.time >= self.lifetime:
+            self.delete()
+            return
 
-        if not self.particles:
-            self.active = False
+        acceleration = self.gravity_scale * gravity
+        self.velocity = self.initial_velocity + acceleration * self.time
+        self.position = self.initial_position + self.initial_velocity * self.time \
+            + 0.5 * acceleration * self.time ** 2
+        self.size = self.start_size + self.time / self.lifetime * (self.end_size - self.start_size)
 
     def draw(self, batch, camera, image_handler):
         if not self.active:
             return
 
-        for p in self.particles:
-            p.draw(batch, camera, image_handler)
+        angle = np.arctan2(self.velocity[:, 1], self.velocity[:, 0])
+        scale_x = (1 + self.stretch * np.linalg.norm(self.velocity, axis=1)) * self.size
+        opacity = (1 - (self.time / self.lifetime)**4) * 255 if self.end_size > 0 else 255
+        camera.draw_particles(image_handler, self.image_path, self.position, angle, scale_x, self.size, opacity,
+                              self.layer)
 
     def delete(self):
-        for p in self.particles:
-            p.delete()
-        self.particles.clear()
-
-
-class Particle:
-    def __init__(self, image_path, position, velocity, lifetime, start_size, end_size=0.0, gravity_scale=1.0,
-                 stretch=0.0):
-        self.initial_position = position.copy()
-        self.position = position.copy()
-        self.initial_velocity = velocity.copy()
-        self.velocity = np.zeros_like(velocity)
-        self.gravity_scale = gravity_scale
-        self.angle = 0.0
-        self.lifetime = lifetime
-        self.size = start_size
-        self.start_size = start_size
-        self.end_size = end_size
-        self.stretch = stretch
-        self.time = 0.0
-        self.layer = 13
-        self.image_path = image_path
-        self.sprite = None
-
-    def delete(self):
-        if self.sprite:
-            self.sprite.delete()
-
-    def update(self, gravity, time_step):
-        self.time = min(self.time + time_step, self.lifetime)
-
-        self.velocity = self.initial_velocity + self.gravity_scale * gravity * self.time
-        self.position = self.initial_position + self.initial_velocity * self.time \
-            + 0.5 * self.gravity_scale * gravity * self.time ** 2
-        self.angle = polar_angle(self.velocity)
-        self.size = self.start_size + self.time / self.lifetime * (self.end_size - self.start_size)
-
-    def draw(self, batch, camera, image_handler):
-        self.sprite = camera.draw_sprite(image_handler, self.image_path, self.position, angle=self.angle,
-                                         batch=batch, layer=self.layer, sprite=self.sprite,
-                                         scale_x=(1 + self.stretch * norm(self.velocity)) * self.size,
-                                         scale_y=self.size)
-        if self.end_size > 0:
-            self.sprite.opacity = (1 - (self.time / self.lifetime)**4) * 255
+        self.active = False
 
 
 class MuzzleFlash:
@@ -106,17 +70,14 @@ class MuzzleFlash:
         self.size = self.start_size
         self.image_path = 'muzzleflash'
         self.layer = 13
-        self.sprite = None
         self.active = True
 
     def delete(self):
-        if self.sprite:
-            self.sprite.delete()
+        self.active = False
 
     def update(self, gravity, time_step):
         self.time += time_step
         if self.time >= self.lifetime:
-            self.active = False
             self.delete()
             return
 
@@ -124,9 +85,11 @@ class MuzzleFlash:
         self.size = (1 - (self.time / self.lifetime)**2) * self.start_size
 
     def draw(self, batch, camera, image_handler):
-        self.sprite = camera.draw_sprite(image_handler, self.image_path, self.position, angle=self.angle,
-                                         batch=batch, layer=self.layer, sprite=self.sprite,
-                                         scale_x=self.start_size, scale_y=self.size)
+        if not self.active:
+            return
+
+        camera.draw_particles(image_handler, self.image_path, self.position[np.newaxis], self.angle,
+                              self.start_size, self.size, layer=self.layer)
 
 
 class BloodSplatter(Cloud):
@@ -137,8 +100,23 @@ class BloodSplatter(Cloud):
 class Explosion(Cloud):
     def __init__(self, position):
         super().__init__('smoke', position, 1.0 * basis(1), 5, 1.0, start_size=4.0, end_size=0.0, gravity_scale=-0.5)
-        self.particles.append(Particle('explosion', position, np.zeros(2), 0.5, start_size=2.0, end_size=2.5,
-                                       gravity_scale=0.0))
+        self.fireball = Cloud('explosion', position, np.zeros(2), 1, 0.5, start_size=2.0, end_size=2.5,
+                              gravity_scale=0.0)
+        self.fireball.initial_velocity[:] = 0.0
+        self.fireball.velocity[:] = 0.0
+
+    def update(self, gravity, time_step):
+        super().update(gravity, time_step)
+        if self.fireball.active:
+            self.fireball.update(gravity, time_step)
+
+    def draw(self, batch, camera, image_handler):
+        super().draw(batch, camera, image_handler)
+        self.fireball.draw(batch, camera, image_handler)
+
+    def delete(self):
+        super().delete()
+        self.fireball.delete()
 
 
 class Dust(Cloud):
@@ -123,14 +123,6 @@ class Player(Destroyable):
         self.back_hand.lower.sprite = None
         self.body.angle = 0.0
 
-        if self.body.shadow_sprite:
-            self.body.shadow_sprite.delete()
-            self.body.shadow_sprite = None
-
-        if self.head.shadow_sprite:
-            self.head.shadow_sprite.delete()
-            self.head.shadow_sprite = None
-
         self.destroyed = False
         self.health = 100
         self.rotate(-self.angle)
@@ -748,13 +740,6 @@ class Limb(PhysicsObject, AnimatedObject):
         for p in self.particle_clouds:
             p.delete()
         self.particle_clouds.clear()
-        if self.shadow_sprite:
-            self.shadow_sprite.delete()
-            self.shadow_sprite = None
-        for part in [self.upper, self.lower]:
-            if part.shadow_sprite:
-                part.shadow_sprite.delete()
-                part.shadow_sprite = None
         self.gravity_scale = 0.0
         self.active = True
 
@@ -786,15 +771,15 @@ class Limb(PhysicsObject, AnimatedObject):
 
         self.upper.position[:] = pos
         self.upper.angle = angle
+        self.upper.stretch = 2 * norm(joint - start) / self.length
         self.upper.draw(batch, camera, image_handler)
-        self.upper.sprite.scale_x *= 2 * norm(joint - start) / self.length
 
         pos = 0.5 * (joint + end)
         angle = polar_angle(end - joint)
         self.lower.position[:] = pos
         self.lower.angle = angle
+        self.lower.stretch = 2 * norm(joint - end) / self.length
         self.lower.draw(batch, camera, image_handler)
-        self.lower.sprite.scale_x *= 2 * norm(joint - end) / self.length
 
         super().draw(batch, camera, image_handler)
 
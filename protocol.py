@@ -0,0 +1,570 @@
+import pickle
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+import levelfile
+from bullet import Bullet, Pellet, Arrow
+from collider import Group
+from enemy import Enemy
+from gameobject import GameObject, PhysicsObject, Destroyable
+from goal import Exit, Basket
+from player import Player
+from prop import Crate, Box, Ball, Television
+from text import Tutorial
+from weapon import Gun, Revolver, Shotgun, SawedOff, Sniper, MachineGun, Bow, Grenade, Axe, Shield
+
+
+VERSION = 3
+
+HEADER = struct.Struct('<BB')
+
+WELCOME, DELTA, INPUT, ROLLBACK_WELCOME, ROLLBACK_INPUTS, ROLLBACK_STATE, JOIN, LEAVE, KILL, SCORE = range(10)
+
+# type and sound ids are shared by every client, so new ones must only ever be appended
+TYPES = [None, Crate, Box, Ball, Television, Revolver, Shotgun, SawedOff, Sniper, MachineGun, Bow, Grenade, Axe, Shield,
+         Tutorial, Player, Enemy, Bullet, Pellet, Arrow, Exit, Basket]
+TYPE_IDS = {t: i for i, t in enumerate(TYPES) if t}
+
+SOUNDS = ['alarm', 'ball', 'bow_pull', 'bow_release', 'bump', 'cancel', 'crate', 'crate_break', 'glass', 'grenade',
+          'gun', 'hit', 'jump', 'menu', 'pin', 'prologue', 'revolver', 'sawed_off', 'select', 'shotgun', 'sniper',
+          'static', 'swing', 'sword', 'walk', 'wear']
+SOUND_IDS = {s: i for i, s in enumerate(SOUNDS)}
+
+BUTTONS = ['A', 'B', 'X', 'Y', 'LB', 'RB', 'SELECT', 'START']
+
+POSITION_SCALE = 1024
+VELOCITY_SCALE = 64
+ANGLE_SCALE = 65536 / (2 * np.pi)
+FRACTION_SCALE = 65535
+STICK_SCALE = 32767
+TRIGGER_SCALE = 255
+
+# every class that extends get_data adds its own fields, the layout of an entity is the fields of its bases in order
+FIELDS = {
+    GameObject: ('id', 'type', 'position', 'flag', 'angle'),
+    PhysicsObject: ('velocity', 'sounds', 'group', 'flag'),
+    Destroyable: ('health', ),
+    Gun: ('flag', ),
+    Bow: ('fraction', ),
+    Television: ('sound', ),
+    Tutorial: ('index', ),
+    Player: ('position', 'fraction'),
+}
+
+CODES = {'id': 'i', 'type': '', 'position': 'i', 'flag': '', 'angle': 'H', 'velocity': 'h', 'sounds': 'I',
+         'group': 'B', 'health': 'e', 'fraction': 'H', 'sound': 'B', 'index': 'B'}
+
+# the entities of a state message should fit in one packet with a full level of players and objects
+ENTITY_BUDGET = 40
+
+ENTITY = struct.Struct('<H')
+COUNT = struct.Struct('<H')
+INPUT_RECORD = struct.Struct('<hhhhBBBB')
+FRAME = struct.Struct('<I')
+PLAYER = struct.Struct('<i')
+ROLLBACK = struct.Struct('<iI')
+SEQUENCE = struct.Struct('<II')
+CHANGE = struct.Struct('<iHH')
+KEY = struct.Struct('<i')
+SCORE_VALUE = struct.Struct('<H')
+
+# a delta against no baseline is a full state
+NO_BASELINE = 0xFFFFFFFF
+MAX_BASELINES = 64
+
+layouts = dict()
+change_layouts = dict()
+
+
+# numpy scalars are converted to floats first, rounding them directly is several times slower
+def fixed(value, scale, limit):
+    return max(-limit - 1, min(limit, round(float(value) * scale)))
+
+
+def encode_position(value):
+    return round(float(value) * POSITION_SCALE)
+
+
+def encode_velocity(value):
+    return fixed(value, VELOCITY_SCALE, 2 ** 15 - 1)
+
+
+def encode_angle(value):
+    return round(float(value) * ANGLE_SCALE) % 65536
+
+
+def encode_sounds(value):
+    bits = 0
+    for s in value:
+        bits |= 1 << SOUND_IDS[s]
+
+    return bits
+
+
+def encode_fraction(value):
+    return fixed(value, FRACTION_SCALE, FRACTION_SCALE)
+
+
+def decode_sounds(value):
+    return {SOUNDS[i] for i in range(value.bit_length()) if value >> i & 1}
+
+
+# how each field is converted to and from its packed values
+ENCODERS = {'id': int, 'position': encode_position, 'angle': encode_angle, 'velocity': encode_velocity,
+            'sounds': encode_sounds, 'group': int, 'health': float, 'fraction': encode_fraction,
+            'sound': SOUND_IDS.__getitem__, 'index': int}
+DECODERS = {'id': int, 'position': lambda v: v / POSITION_SCALE, 'angle': lambda v: v / ANGLE_SCALE,
+            'velocity': lambda v: v / VELOCITY_SCALE, 'sounds': decode_sounds, 'group': {g.value: g for g in Group}.__getitem__, 'health': float,
+            'fraction': lambda v: v / FRACTION_SCALE, 'sound': SOUNDS.__getitem__, 'index': int}
+
+
+def get_layout(cls):
+    # compiles the fields of a class into a struct and a list of conversions for each item of its get_data
+    if cls not in layouts:
+        fields = []
+        for base in reversed(cls.__mro__):
+            if base in FIELDS:
+                fields += [f for f in FIELDS[base] for _ in range(2 if f in {'position', 'velocity'} else 1)]
+
+        encoders = []
+        flags = []
+        decoders = []
+        for i, field in enumerate(fields):
+            if field == 'type':
+                decoders.append((-1, lambda v, c=cls: c))
+            elif field == 'flag':
+                bit = 1 << len(flags)
+                flags.append((i, bit))
+                if bit == 1:
+                    decoders.append((-1, lambda v: -1 if v & 1 else 1))
+                else:
+                    decoders.append((-1, lambda v, b=bit: bool(v & b)))
+            else:
+                decoders.append((len(encoders), DECODERS[field]))
+                encoders.append((i, ENCODERS[field]))
+
+        codes = tuple(CODES[f] for f in fields if CODES[f]) + ('B', )
+        if len(codes) > 16:
+            raise ValueError(f'{cls.__name__} has too many fields for a change mask')
+
+        layout = struct.Struct('<H' + ''.join(codes))
+        layouts[cls] = (layout, TYPE_IDS[cls], tuple(encoders), flags[0][0], tuple(flags[1:]), tuple(decoders),
+                        codes)
+
+    return layouts[cls]
+
+
+def get_change_layout(type_id, mask):
+    # the struct of the values of an entity that are set in a change mask
+    key = (type_id, mask)
+    if key not in change_layouts:
+        codes = get_layout(TYPES[type_id])[6]
+        change_layouts[key] = struct.Struct('<' + ''.join(c for i, c in enumerate(codes) if mask >> i & 1))
+
+    return change_layouts[key]
+
+
+def entity_values(data):
+    # the packed values of an entity, equal values always mean equal entities on the client
+    _, type_id, encoders, direction, flags, _, _ = get_layout(data[1])
+
+    # the first flag of every entity is its direction
+    bits = 1 if data[direction] < 0 else 0
+    for i, bit in flags:
+        if data[i]:
+            bits |= bit
+
+    return type_id, tuple([f(data[i]) for i, f in encoders]) + (bits, )
+
+
+def entity_data(type_id, values):
+    decoders = get_layout(TYPES[type_id])[5]
+    return tuple([f(values[i]) for i, f in decoders])
+
+
+def encode_entity(data):
+    type_id, values = entity_values(data)
+    return get_layout(data[1])[0].pack(type_id, *values)
+
+
+def decode_entity(buffer, offset):
+    type_id = ENTITY.unpack_from(buffer, offset)[0]
+    layout = get_layout(TYPES[type_id])[0]
+    values = layout.unpack_from(buffer, offset)[1:]
+
+    return entity_data(type_id, values), offset + layout.size
+
+
+def encode_entities(entities):
+    return COUNT.pack(len(entities)) + b''.join(encode_entity(e) for e in entities)
+
+
+def decode_entities(buffer, offset):
+    count = COUNT.unpack_from(buffer, offset)[0]
+    offset += COUNT.size
+
+    entities = []
+    for _ in range(count):
+        data, offset = decode_entity(buffer, offset)
+        entities.append(data)
+
+    return entities, offset
+
+
+def encode_input(data):
+    down = sum(1 << i for i, b in enumerate(BUTTONS) if data[6][b])
+    pressed = sum(1 << i for i, b in enumerate(BUTTONS) if data[7][b])
+
+    return INPUT_RECORD.pack(*(fixed(v, STICK_SCALE, STICK_SCALE) for v in data[0:4]),
+                             *(fixed(v, TRIGGER_SCALE, TRIGGER_SCALE) for v in data[4:6]), down, pressed)
+
+
+def decode_input(buffer, offset=0):
+    values = INPUT_RECORD.unpack_from(buffer, offset)
+    down = {b: bool(values[6] & (1 << i)) for i, b in enumerate(BUTTONS)}
+    pressed = {b: bool(values[7] & (1 << i)) for i, b in enumerate(BUTTONS)}
+
+    return tuple(v / STICK_SCALE for v in values[0:4]) + tuple(v / TRIGGER_SCALE for v in values[4:6]) + \
+        (down, pressed), offset + INPUT_RECORD.size
+
+
+def quantize_input(data):
+    # the input exactly as every other client will decode it
+    return decode_input(encode_input(data))[0]
+
+
+def encode_level(data):
+    # level geometry uses the level file format, the objects in it are sent as entities since they can be anything
+    buffer = levelfile.encode(data[:2] + ((), ) + data[3:])
+    return FRAME.pack(len(buffer)) + buffer + encode_entities(data[2])
+
+
+def encode_changes(entities, baseline):
+    # entities that are new or changed type are sent whole, others only with the values that differ from the baseline
+    chunks = []
+    for key, (type_id, values) in entities.items():
+        old = baseline.get(key)
+        if old is None or old[0] != type_id:
+            mask = (1 << len(values)) - 1
+        else:
+            mask = 0
+            for i, (v, o) in enumerate(zip(values, old[1])):
+                if v != o:
+                    mask |= 1 << i
+            if not mask:
+                continue
+
+        chunks.append(CHANGE.pack(key, type_id, mask) +
+                      get_change_layout(type_id, mask).pack(*[v for i, v in enumerate(values) if mask >> i & 1]))
+
+    removed = [k for k in baseline if k not in entities]
+
+    return COUNT.pack(len(chunks)) + b''.join(chunks) + COUNT.pack(len(removed)) + \
+        b''.join(KEY.pack(k) for k in removed)
+
+
+def decode_changes(buffer, offset):
+    count = COUNT.unpack_from(buffer, offset)[0]
+    offset += COUNT.size
+
+    changes = []
+    for _ in range(count):
+        key, type_id, mask = CHANGE.unpack_from(buffer, offset)
+        layout = get_change_layout(type_id, mask)
+        changes.append((key, type_id, mask, layout.unpack_from(buffer, offset + CHANGE.size)))
+        offset += CHANGE.size + layout.size
+
+    count = COUNT.unpack_from(buffer, offset)[0]
+    offset += COUNT.size
+    removed = [KEY.unpack_from(buffer, offset + i * KEY.size)[0] for i in range(count)]
+
+    return (changes, removed), offset + count * KEY.size
+
+
+class DeltaEncoder:
+    # the states of the world by sequence number, a client gets the latest one encoded against the latest one it has
+    # acknowledged so only what changed since is sent, and clients with the same baseline share the message
+    def __init__(self):
+        self.sequence = 0
+        self.baselines = dict()
+        self.latest = (0, (dict(), dict()), dict())
+
+    def add(self, players, objects):
+        state = tuple({d[0]: entity_values(d) for d in entities} for entities in (players, objects))
+        sequence = self.sequence + 1
+        self.baselines[sequence] = state
+
+        # a client that stops acknowledging only holds on to a limited number of states
+        while len(self.baselines) > MAX_BASELINES:
+            del self.baselines[min(self.baselines)]
+
+        # readers on other threads take the latest state as a whole, the sequence is only advanced once it is there
+        self.latest = (sequence, state, dict())
+        self.sequence = sequence
+
+    def baseline(self, ack, full, time, interval):
+        # for a client that is sent states without waiting for them, the ack to encode against and the full state it
+        # was last sent as (sequence, time), while that full state may still be on its way the client gets deltas
+        # against it instead of another full state
+        # an ack older than that full state is not used again, the client may have dropped it for the deltas since
+        if ack in self.baselines and (full is None or ack >= full[0]):
+            return ack, full
+
+        if full is not None and full[0] in self.baselines and time - full[1] < interval:
+            return full[0], full
+
+        return NO_BASELINE, (self.sequence, time)
+
+    def encode(self, ack):
+        # returns the sequence of the latest state and the state encoded against the baseline ack
+        sequence, state, messages = self.latest
+        if ack in messages:
+            return sequence, messages[ack]
+
+        baseline = self.baselines.get(ack)
+        if baseline is None:
+            baseline = (dict(), dict())
+            ack = NO_BASELINE
+
+        message = HEADER.pack(VERSION, DELTA) + SEQUENCE.pack(sequence, ack) + encode_changes(state[0], baseline[0]) + \
+            encode_changes(state[1], baseline[1])
+        messages[ack] = message
+
+        return sequence, message
+
+
+class DeltaDecoder:
+    # rebuilds the states of the server from deltas on the network thread, what changed piles up until the game
+    # takes it so no state is ever applied halfway
+    def __init__(self):
+        self.ack = NO_BASELINE
+        self.baselines = dict()
+        self.current = (dict(), dict())
+
+        self.lock = threading.Lock()
+        self.pending = ((dict(), set()), (dict(), set()))
+
+    def apply(self, delta):
+        sequence, ack, sections = delta
+        if ack == NO_BASELINE:
+            baseline = (dict(), dict())
+        elif ack in self.baselines:
+            baseline = self.baselines[ack]
+        else:
+            # the state is dropped and the last one applied stays acknowledged, the sender has it unless it is so old
+            # that the next state is a full one anyway
+            return
+
+        state = []
+        result = []
+        for (changes, removed), entities, current in zip(sections, baseline, self.current):
+            entities = dict(entities)
+            for key, type_id, mask, values in changes:
+                old = entities.get(key)
+                if old is not None and old[0] == type_id and mask != (1 << len(old[1])) - 1:
+                    merged = list(old[1])
+                    changed = iter(values)
+                    for i in range(len(merged)):
+                        if mask >> i & 1:
+                            merged[i] = next(changed)
+                    values = tuple(merged)
+                entities[key] = (type_id, values)
+
+            for key in removed:
+                entities.pop(key, None)
+
+            # the baseline can be older than the last applied state, so differences are taken against that instead
+            result.append(([entity_data(*v) for k, v in entities.items() if current.get(k) != v],
+                           [k for k in current if k not in entities]))
+            state.append(entities)
+
+        # acks only move forward, so the sender never again encodes against a baseline older than the one it used
+        # here, a full state says nothing about which acks the sender still has and leaves every baseline alone
+        if ack != NO_BASELINE:
+            for s in [s for s in self.baselines if s < ack]:
+                del self.baselines[s]
+
+        self.current = tuple(state)
+        self.baselines[sequence] = self.current
+        self.ack = sequence
+
+        while len(self.baselines) > MAX_BASELINES:
+            del self.baselines[min(self.baselines)]
+
+        with self.lock:
+            for (changed, removed), (pending, pending_removed) in zip(result, self.pending):
+                for data in changed:
+                    pending[data[0]] = data
+                    pending_removed.discard(data[0])
+                for key in removed:
+                    pending.pop(key, None)
+                    pending_removed.add(key)
+
+    def take(self):
+        # changed players, removed players, changed objects and removed objects since the last call
+        with self.lock:
+            (players, removed_players), (objects, removed_objects) = self.pending
+            self.pending = ((dict(), set()), (dict(), set()))
+
+        return list(players.values()), removed_players, list(objects.values()), removed_objects
+
+
+def decode_level(buffer, offset):
+    length = FRAME.unpack_from(buffer, offset)[0]
+    offset += FRAME.size
+    data = levelfile.decode(buffer[offset:offset + length])
+    objects, offset = decode_entities(buffer, offset + length)
+
+    return data[:2] + (tuple(objects), ) + data[3:], offset
+
+
+def welcome(player, level):
+    return HEADER.pack(VERSION, WELCOME) + encode_entity(player) + encode_level(level)
+
+
+def rollback_welcome(network_id, seed, level):
+    return HEADER.pack(VERSION, ROLLBACK_WELCOME) + ROLLBACK.pack(network_id, seed) + encode_level(level)
+
+
+def controller_input(data, ack=NO_BASELINE):
+    return HEADER.pack(VERSION, INPUT) + FRAME.pack(ack) + encode_input(data)
+
+
+def rollback_inputs(inputs):
+    return HEADER.pack(VERSION, ROLLBACK_INPUTS) + COUNT.pack(len(inputs)) + \
+        b''.join(FRAME.pack(frame) + encode_input(data) for frame, data in inputs)
+
+
+def rollback_state(roster, left, inputs):
+    return HEADER.pack(VERSION, ROLLBACK_STATE) + COUNT.pack(len(roster)) + \
+        b''.join(PLAYER.pack(k) for k in roster) + COUNT.pack(len(left)) + \
+        b''.join(ROLLBACK.pack(k, frames) for k, frames in left) + COUNT.pack(len(inputs)) + \
+        b''.join(PLAYER.pack(k) + FRAME.pack(frame) + encode_input(data) for k, frame, data in inputs)
+
+
+def join(network_id):
+    return HEADER.pack(VERSION, JOIN) + PLAYER.pack(network_id)
+
+
+def leave(network_id):
+    return HEADER.pack(VERSION, LEAVE) + PLAYER.pack(network_id)
+
+
+def kill(network_id):
+    return HEADER.pack(VERSION, KILL) + PLAYER.pack(network_id)
+
+
+def score(scores):
+    return HEADER.pack(VERSION, SCORE) + COUNT.pack(len(scores)) + b''.join(SCORE_VALUE.pack(s) for s in scores)
+
+
+def decode(buffer):
+    version, message = HEADER.unpack_from(buffer)
+    if version != VERSION:
+        raise ValueError(f'Protocol version {version} does not match version {VERSION}')
+    offset = HEADER.size
+
+    if message == WELCOME:
+        player, offset = decode_entity(buffer, offset)
+        level, offset = decode_level(buffer, offset)
+        return message, (player, level)
+    if message == ROLLBACK_WELCOME:
+        network_id, seed = ROLLBACK.unpack_from(buffer, offset)
+        level, offset = decode_level(buffer, offset + ROLLBACK.size)
+        return message, (network_id, seed, level)
+    if message == DELTA:
+        sequence, ack = SEQUENCE.unpack_from(buffer, offset)
+        players, offset = decode_changes(buffer, offset + SEQUENCE.size)
+        objects, offset = decode_changes(buffer, offset)
+        return message, (sequence, ack, (players, objects))
+    if message == INPUT:
+        ack = FRAME.unpack_from(buffer, offset)[0]
+        return message, (decode_input(buffer, offset + FRAME.size)[0], ack)
+    if message == ROLLBACK_INPUTS:
+        count = COUNT.unpack_from(buffer, offset)[0]
+        offset += COUNT.size
+        inputs = []
+        for _ in range(count):
+            frame = FRAME.unpack_from(buffer, offset)[0]
+            data, offset = decode_input(buffer, offset + FRAME.size)
+            inputs.append((frame, data))
+        return message, inputs
+    if message == ROLLBACK_STATE:
+        count = COUNT.unpack_from(buffer, offset)[0]
+        offset += COUNT.size
+        roster = [PLAYER.unpack_from(buffer, offset + i * PLAYER.size)[0] for i in range(count)]
+        offset += count * PLAYER.size
+        count = COUNT.unpack_from(buffer, offset)[0]
+        offset += COUNT.size
+        left = [ROLLBACK.unpack_from(buffer, offset + i * ROLLBACK.size) for i in range(count)]
+        offset += count * ROLLBACK.size
+        count = COUNT.unpack_from(buffer, offset)[0]
+        offset += COUNT.size
+        inputs = []
+        for _ in range(count):
+            network_id = PLAYER.unpack_from(buffer, offset)[0]
+            frame = FRAME.unpack_from(buffer, offset + PLAYER.size)[0]
+            data, offset = decode_input(buffer, offset + PLAYER.size + FRAME.size)
+            inputs.append((network_id, frame, data))
+        return message, (roster, left, inputs)
+    if message in (JOIN, LEAVE, KILL):
+        return message, PLAYER.unpack_from(buffer, offset)[0]
+    if message == SCORE:
+        count = COUNT.unpack_from(buffer, offset)[0]
+        offset += COUNT.size
+        return message, tuple(SCORE_VALUE.unpack_from(buffer, offset + i * SCORE_VALUE.size)[0] for i in range(count))
+
+    raise ValueError(f'Unknown message type {message}')
+
+
+def benchmark(name, data, encode, decode, repeats=1000):
+    pickled = pickle.dumps(data)
+    encoded = encode(data)
+
+    timings = []
+    for function, argument in [(pickle.dumps, data), (pickle.loads, pickled), (encode, data), (decode, encoded)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            function(argument)
+        timings.append(1e6 * (time.perf_counter() - start) / repeats)
+
+    print(f'  {name:<12} pickle {len(pickled):5d} B {timings[0]:7.1f} / {timings[1]:7.1f} us   '
+          f'binary {len(encoded):5d} B {timings[2]:7.1f} / {timings[3]:7.1f} us')
+
+
+if __name__ == '__main__':
+    # prints the size of every entity type against the budget and compares the messages of a level with pickle
+    from pyglet import options
+    options['headless'] = True
+
+    from inputhandler import Controller
+    from level import Level
+
+    print(f'bytes per entity, budget {ENTITY_BUDGET}')
+    for cls in TYPES[1:]:
+        size = get_layout(cls)[0].size
+        print(f'  {cls.__name__:<12} {size:3d}' + ('  over budget' if size > ENTITY_BUDGET else ''))
+
+    level = Level(sys.argv[1] if len(sys.argv) > 1 else 'multiplayer/circle')
+    players = [Player(p.position, -1, i) for i, p in enumerate(level.player_spawns)]
+    for p in players:
+        p.sounds.add('walk')
+    objects = [o.get_data() for o in level.objects.values()]
+    states = ([p.get_data() for p in players], objects)
+    controller = Controller(-1).get_data()
+
+    print('encode / decode')
+    benchmark('input', controller, controller_input, decode)
+    deltas = DeltaEncoder()
+    benchmark('state', states, lambda d: deltas.add(*d) or deltas.encode(NO_BASELINE)[1], decode)
+
+    # a state against an acknowledged baseline where only the players have moved
+    for p in players:
+        p.position[0] += 1
+    states = ([p.get_data() for p in players], objects)
+    benchmark('delta', states, lambda d: deltas.add(*d) or deltas.encode(deltas.sequence - 1)[1], decode)
+    benchmark('level', level.get_data(), lambda d: welcome(players[0].get_data(), d), decode, 100)
@@ -0,0 +1,196 @@
+import threading
+import time
+
+import numpy as np
+
+from inputhandler import Controller
+from protocol import quantize_input
+from snapshot import WorldSnapshot
+
+
+class Rollback:
+    def __init__(self, level, players, colliders, local_id, seed, time_step=1 / 60, max_frames=8, budget=0.008):
+        self.level = level
+        self.players = players
+        self.colliders = colliders
+        self.local_id = local_id
+        self.seed = seed
+        self.time_step = time_step
+        self.max_frames = max_frames
+        self.budget = budget
+
+        self.frame = 0
+        self.accumulator = 0.0
+        self.running = False
+        self.roster = []
+
+        # players that left the session by how many frames they sent, every later frame of theirs is neutral
+        self.left = dict()
+        self.received_left = []
+
+        # inputs received or recorded for each player by frame, and the inputs the simulation actually used
+        self.inputs = dict()
+        self.used = dict()
+        self.confirmed = dict()
+        self.controllers = dict()
+        self.neutral = Controller(-1).get_data()
+
+        self.snapshots = dict()
+        self.rollback_frame = None
+        self.step_time = 0.0
+
+        self.lock = threading.Lock()
+        self.received = []
+        self.outgoing = []
+
+    def start(self):
+        for k in self.players:
+            self.inputs[k] = dict()
+            self.used[k] = dict()
+            self.confirmed[k] = -1
+            self.controllers[k] = Controller(-1)
+
+        np.random.seed(self.seed)
+        self.level.rollback = True
+        self.running = True
+
+    def receive(self, roster, left, inputs):
+        # called from the network thread with the players in the session, the players that left it as (network id,
+        # frames sent) and their inputs as (network id, frame, data)
+        with self.lock:
+            self.roster = roster
+            self.received_left = left
+            self.received.extend(inputs)
+
+    def get_outgoing(self):
+        with self.lock:
+            outgoing = self.outgoing
+            self.outgoing = []
+
+        return outgoing
+
+    @property
+    def window(self):
+        # how many frames the simulation may run ahead of the latest confirmed inputs, limited so that rolling all of
+        # them back fits in the time budget of one display frame
+        if not self.step_time:
+            return self.max_frames
+
+        return max(1, min(self.max_frames, int(self.budget / self.step_time)))
+
+    def get_input(self, network_id, frame):
+        inputs = self.inputs[network_id]
+        if frame in inputs:
+            return inputs[frame]
+
+        if network_id in self.left and frame >= self.left[network_id]:
+            return self.neutral
+
+        # remote players are predicted to keep holding what they held last, presses are not repeated
+        confirmed = self.confirmed[network_id]
+        if confirmed == -1:
+            return self.neutral
+
+        data = inputs[confirmed]
+        return data[:7] + ({b: False for b in data[7]}, )
+
+    def add_inputs(self):
+        with self.lock:
+            received = self.received
+            self.received = []
+            left = self.received_left
+
+        for network_id, frame, data in received:
+            if network_id not in self.inputs:
+                continue
+
+            inputs = self.inputs[network_id]
+            inputs[frame] = data
+            while self.confirmed[network_id] + 1 in inputs:
+                self.confirmed[network_id] += 1
+
+            if frame < self.frame and self.used[network_id].get(frame) != data:
+                if self.rollback_frame is None or frame < self.rollback_frame:
+                    self.rollback_frame = frame
+
+        # all inputs a player sent arrive no later than the news that it left, the frames after them were predicted
+        # and are replayed if the prediction was not neutral
+        for network_id, frames in left:
+            if network_id not in self.inputs or network_id in self.left:
+                continue
+
+            self.left[network_id] = frames
+            for frame in range(frames, self.frame):
+                if self.used[network_id].get(frame, self.neutral) != self.neutral:
+                    if self.rollback_frame is None or frame < self.rollback_frame:
+                        self.rollback_frame = frame
+                    break
+
+    def step(self):
+        start = time.perf_counter()
+
+        frame = self.frame
+        self.snapshots[frame] = WorldSnapshot(self.level, self.players)
+
+        for k, player in self.players.items():
+            data = self.get_input(k, frame)
+            self.used[k][frame] = data
+            self.controllers[k].apply_data(data)
+            player.input(self.controllers[k])
+
+        for player in self.players.values():
+            player.update(self.level.gravity, self.time_step, self.colliders)
+
+        self.level.update(self.time_step, self.colliders)
+
+        self.frame += 1
+
+        self.step_time = 0.9 * self.step_time + 0.1 * (time.perf_counter() - start) if self.step_time else \
+            time.perf_counter() - start
+
+    def update(self, local_data, time_step):
+        # every client simulates on the same fixed step whatever its own frame rate is
+        self.accumulator += time_step
+        while self.accumulator >= self.time_step:
+            if not self.advance(local_data):
+                self.accumulator = min(self.accumulator, self.time_step)
+                break
+            self.accumulator -= self.time_step
+            local_data = local_data[:7] + ({b: False for b in local_data[7]}, )
+
+    def advance(self, local_data):
+        # the local player has to be simulated with the same quantized input the other clients receive
+        local_data = quantize_input(local_data)
+
+        self.add_inputs()
+
+        if self.rollback_frame is not None:
+            frame = self.frame
+            self.snapshots[self.rollback_frame].restore(self.colliders)
+            self.frame = self.rollback_frame
+            self.rollback_frame = None
+            while self.frame < frame:
+                self.step()
+
+        # players that left never hold the session back
+        remote = [self.confirmed[k] for k in self.players if k != self.local_id and k not in self.left]
+        confirmed = min(remote) if remote else self.frame
+        if self.frame - confirmed > self.window:
+            return False
+
+        self.inputs[self.local_id][self.frame] = local_data
+        self.confirmed[self.local_id] = self.frame
+        with self.lock:
+            self.outgoing.append((self.frame, local_data))
+
+        self.step()
+
+        # nothing at or before the oldest confirmed frame can be rolled back anymore
+        for frame in [f for f in self.snapshots if f <= confirmed]:
+            del self.snapshots[frame]
+            for k in self.players:
+                self.used[k].pop(frame, None)
+                if frame < self.confirmed[k]:
+                    self.inputs[k].pop(frame, None)
+
+        return True
@@ -1,35 +1,81 @@
+import asyncio
 import os
 import socket
-from _thread import *
-import pickle
+import struct
+import sys
 
-import pygame
+import protocol
 
 from inputhandler import Controller
 from level import Level
-from network import PACKET_SIZE
+from network import FULL_STATE_INTERVAL, Channel, frame, read_message
 from player import Player
 from weapon import Gun
 
 
-class Server:
-    def __init__(self):
-        server = socket.gethostbyname(socket.gethostname())
-        port = 5555
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+TICK_RATE = 60
+SEND_RATE = 30
 
-        try:
-            self.sock.bind((server, port))
-        except socket.error as e:
-            str(e)
+# a rollback session starts with this many players and nobody can join it afterwards
+SESSION_SIZE = 2
+
+# a client is dropped when it stops asking for states or cannot keep up with them
+CLIENT_TIMEOUT = 5.0
+MAX_WRITE_BUFFER = 1 << 18
+
+
+class Client:
+    def __init__(self, writer, time, address=None):
+        self.writer = writer
+        self.ack = protocol.NO_BASELINE
+        self.full = None
+        self.waiting = False
+        self.time = time
+
+        # clients over udp have no stream, only an address and the state of their channel
+        self.address = address
+        self.channel = Channel() if address else None
+
+
+class Datagrams(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
 
-        self.sock.listen(2)
-        print(f'Server started, ip={server}, waiting for a connection')
+    def datagram_received(self, packet, address):
+        self.server.datagram_received(self.transport, packet, address)
+
+
+class Server:
+    def __init__(self, rollback=False, send_rate=SEND_RATE, udp=False):
+        self.address = (socket.gethostbyname(socket.gethostname()), 5555)
 
         self.players = dict()
         self.controllers = dict()
+        self.clients = dict()
+        self.addresses = dict()
+        self.killed = set()
+        self.scores = ()
         self.level = None
         self.colliders = []
+        self.network_id = 0
+
+        # in rollback mode the clients simulate the game themselves and the server only relays their inputs
+        self.rollback = rollback
+        self.inputs = dict()
+        self.left = dict()
+        self.seed = int.from_bytes(os.urandom(4), 'little')
+
+        # over udp states are sent unreliably and only events that must not be lost are sent reliably
+        self.udp = udp
+        self.transport = None
+
+        # the world is encoded once every few ticks and every client is sent the same state
+        self.ticks_per_send = max(1, round(TICK_RATE / send_rate))
+        self.deltas = protocol.DeltaEncoder()
 
         self.load_level(os.path.join('multiplayer', 'circle'))
 
@@ -57,63 +103,235 @@ class Server:
         self.controllers[network_id] = Controller(-1)
 
     def start(self):
-        start_new_thread(self.physics_thread, ())
-        p = 0
-        while True:
-            conn, addr = self.sock.accept()
-            print("Connected to:", addr)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        # every connection and the physics run on one event loop, so players join, leave and send inputs only
+        # between ticks
+        # the rollback relay needs every input and stays on tcp
+        if self.udp and not self.rollback:
+            self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: Datagrams(self), local_addr=self.address)
+            print(f'Server started, ip={self.address[0]}, waiting for packets')
+            await self.physics()
+            return
+
+        handler = self.rollback_client if self.rollback else self.game_client
+        server = await asyncio.start_server(handler, *self.address)
+        print(f'Server started, ip={self.address[0]}, waiting for a connection')
+
+        if not self.rollback:
+            asyncio.create_task(self.physics())
+
+        async with server:
+            await server.serve_forever()
+
+    def send_event(self, message):
+        for client in self.clients.values():
+            if client.channel:
+                client.channel.send_reliable(message)
+
+    def datagram_received(self, transport, packet, address):
+        now = asyncio.get_running_loop().time()
+
+        if address in self.addresses:
+            p = self.addresses[address]
+            client = self.clients[p]
+            channel = client.channel
+        else:
+            client = None
+            channel = Channel()
 
-            start_new_thread(self.threaded_client, (conn, p))
-            p += 1
+        try:
+            _, payload = channel.receive(packet, now)
+            input_data = protocol.decode(payload) if payload is not None else None
+            if input_data is not None and input_data[0] != protocol.INPUT:
+                raise ValueError(f'Unexpected message {input_data[0]}')
+        except (ValueError, struct.error) as e:
+            # a stray packet from an unknown address is dropped without a trace
+            if client:
+                print(e)
+            return
+
+        if client is None:
+            # only a well formed input joins the game
+            if input_data is None:
+                return
+
+            print("Connected to:", address)
+            p = self.network_id
+            self.network_id += 1
+
+            self.add_player(p)
+            self.send_event(protocol.join(p))
+            self.addresses[address] = p
+            client = Client(None, now, address)
+            client.channel = channel
+            self.clients[p] = client
+            channel.send_reliable(protocol.welcome(self.players[p].get_data(), self.level.get_data()))
+            for k in self.killed:
+                channel.send_reliable(protocol.kill(k))
+            if self.scores:
+                channel.send_reliable(protocol.score(self.scores))
+
+        client.time = now
+        if input_data is not None:
+            data, ack = input_data[1]
+            self.controllers[p].apply_data(data)
+            client.ack = ack
+
+    def remove_client(self, p):
+        print("Lost connection")
+        client = self.clients.pop(p)
+        del self.addresses[client.address]
+        del self.players[p]
+        del self.controllers[p]
+        self.send_event(protocol.leave(p))
 
-    def threaded_client(self, conn, p):
-        self.add_player(p)
-        data = [self.players[p].get_data(), self.level.get_data()]
-        #print(len(pickle.dumps(data)))
-        conn.send(pickle.dumps(data))
+    async def game_client(self, reader, writer):
+        print("Connected to:", writer.get_extra_info('peername'))
+        p = self.network_id
+        self.network_id += 1
 
-        while True:
-            try:
-                data = pickle.loads(conn.recv(PACKET_SIZE))
+        self.add_player(p)
+        client = Client(writer, asyncio.get_running_loop().time())
+        self.clients[p] = client
 
-                if not data:
-                    break
+        try:
+            writer.write(frame(protocol.welcome(self.players[p].get_data(), self.level.get_data())))
 
-                player = self.players[p]
+            while True:
+                message, (data, ack) = protocol.decode(await read_message(reader))
                 self.controllers[p].apply_data(data)
-                #player.input(self.controllers[p])
 
-                reply = [[v.get_data() for v in self.players.values()],
-                         [o.get_data() for o in self.level.objects.values()]]
+                # the reply is the next state the physics sends out
+                client.ack = ack
+                client.waiting = True
+                client.time = asyncio.get_running_loop().time()
+        except (OSError, EOFError, ValueError, struct.error) as e:
+            print(e)
+
+        print("Lost connection")
+        writer.close()
+        del self.clients[p]
+        del self.players[p]
+        del self.controllers[p]
+
+    async def rollback_client(self, reader, writer):
+        print("Connected to:", writer.get_extra_info('peername'))
+        if len(self.inputs) >= SESSION_SIZE:
+            print("Session already started")
+            writer.close()
+            return
 
-                reply = pickle.dumps(reply)
+        p = self.network_id
+        self.network_id += 1
+        self.inputs[p] = []
 
-                if len(reply) > PACKET_SIZE:
-                    print('Packet too large:', len(reply))
+        sent = dict()
+        try:
+            writer.write(frame(protocol.rollback_welcome(p, self.seed, self.level.get_data())))
 
-                conn.sendall(reply)
-            except:
-                break
+            while True:
+                message, data = protocol.decode(await read_message(reader))
+                self.inputs[p].extend(data)
 
-        print("Lost connection")
-        conn.close()
-        del self.players[p]
+                reply = []
+                for k, inputs in self.inputs.items():
+                    if k != p:
+                        reply += [(k, n, d) for n, d in inputs[sent.get(k, 0):]]
+                        sent[k] = len(inputs)
 
-    def physics_thread(self):
-        clock = pygame.time.Clock()
-        time_step = 1.0 / 60
+                writer.write(frame(protocol.rollback_state(sorted(self.inputs), list(self.left.items()), reply)))
+                await writer.drain()
+        except (OSError, EOFError, ValueError, struct.error) as e:
+            print(e)
 
+        print("Lost connection")
+        writer.close()
+
+        # once the session has started a player that leaves stays in it, the others are told how many frames it sent
+        # and play every later frame with neutral input
+        if len(self.inputs) < SESSION_SIZE:
+            del self.inputs[p]
+        else:
+            self.left[p] = len(self.inputs[p])
+
+        # a session everybody has left is over and the next players start a new one
+        if len(self.left) == len(self.inputs):
+            self.inputs.clear()
+            self.left.clear()
+            self.seed = int.from_bytes(os.urandom(4), 'little')
+
+    def broadcast(self, time):
+        # each client waiting for a state gets one write per send, clients with the same baseline share the message
+        for p, client in list(self.clients.items()):
+            if client.channel:
+                if time - client.time > CLIENT_TIMEOUT:
+                    self.remove_client(p)
+                else:
+                    # a client without a baseline is not sent a full state more often than a round trip
+                    interval = max(FULL_STATE_INTERVAL, 2 * (client.channel.rtt or 0))
+                    ack, client.full = self.deltas.baseline(client.ack, client.full, time, interval)
+                    packet = client.channel.packet(self.deltas.encode(ack)[1], time)
+                    self.transport.sendto(packet, client.address)
+                continue
+
+            if client.writer.is_closing():
+                continue
+
+            if client.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER or \
+                    time - client.time > CLIENT_TIMEOUT:
+                print("Client too slow:", client.writer.get_extra_info('peername'))
+                client.writer.close()
+                continue
+
+            if client.waiting:
+                client.waiting = False
+                client.writer.write(frame(self.deltas.encode(client.ack)[1]))
+
+    def check_events(self):
+        for k, player in self.players.items():
+            if player.destroyed and k not in self.killed:
+                self.killed.add(k)
+                self.send_event(protocol.kill(k))
+        self.killed &= set(self.players)
+
+        scores = tuple(g.score for g in self.level.goals)
+        if scores != self.scores:
+            self.scores = scores
+            self.send_event(protocol.score(scores))
+
+    async def physics(self):
+        loop = asyncio.get_running_loop()
+        time_step = 1.0 / TICK_RATE
+
+        tick = 0
+        next_tick = loop.time()
         while True:
             for p in self.players.values():
                 p.input(self.controllers[p.network_id])
                 p.update(self.level.gravity, time_step, self.colliders)
 
             self.level.update(time_step, self.colliders)
-            self.level.clear_sounds()
 
-            clock.tick(60)
+            if self.udp:
+                self.check_events()
+
+            # sounds pile up between sends so that none are lost
+            tick += 1
+            if tick % self.ticks_per_send == 0:
+                self.deltas.add([v.get_data() for v in self.players.values()],
+                                [o.get_data() for o in self.level.objects.values()])
+                self.level.clear_sounds()
+                self.broadcast(loop.time())
+
+            # ticks that fall too far behind are skipped instead of run back to back
+            next_tick = max(next_tick + time_step, loop.time() - time_step)
+            await asyncio.sleep(next_tick - loop.time())
 
 
 if __name__ == '__main__':
-    s = Server()
+    send_rate = int(sys.argv[sys.argv.index('--send-rate') + 1]) if '--send-rate' in sys.argv else SEND_RATE
+    s = Server('--rollback' in sys.argv, send_rate, '--udp' in sys.argv)
     s.start()
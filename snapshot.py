@@ -0,0 +1,270 @@
+import numpy as np
+
+from collider import Collider, ColliderGroup
+from drawable import Decal
+from gameobject import Animation
+from particle import Cloud, MuzzleFlash
+from text import Text, Icon
+
+
+# sprites, labels and sounds belong to the renderer and are brought up to date on the next draw, the grid squares
+# of colliders are stored separately
+TRANSIENT = {'sprite', 'label', 'label_red', 'label_cyan', 'drawn_state', 'drawn_title_state', 'vertex_list',
+             'sounds', 'collisions', 'left', 'right', 'top', 'bottom'}
+
+# the state of objects of these types is copied, like the debris of a crate or the text of a scoreboard, any other
+# object an entity refers to is kept by reference and must be immutable or never changed by the simulation,
+# containers are copied one level deep
+OWNED = (Decal, Collider, ColliderGroup, Animation, Text, Icon, Cloud, MuzzleFlash)
+
+ARRAY, LIST, DICT, SET, VALUE = range(5)
+
+KINDS = {np.ndarray: ARRAY, list: LIST, dict: DICT, set: SET}
+
+owned_types = dict()
+
+
+def is_owned(value):
+    t = type(value)
+    if t not in owned_types:
+        owned_types[t] = issubclass(t, OWNED)
+
+    return owned_types[t]
+
+
+def walk(roots):
+    # yields the roots and every object they own, objects that are roots themselves or reached through a parent are
+    # only referenced
+    visited = {id(r) for r in roots}
+    stack = list(reversed(roots))
+
+    while stack:
+        entity = stack.pop()
+        yield entity
+
+        for name, value in vars(entity).items():
+            if name in TRANSIENT or name == 'parent':
+                continue
+
+            kind = KINDS.get(type(value), VALUE)
+            if kind is VALUE:
+                values = (value, )
+            elif kind is ARRAY:
+                continue
+            elif kind is DICT:
+                values = value.values()
+            else:
+                values = value
+
+            for v in values:
+                if is_owned(v) and id(v) not in visited:
+                    visited.add(id(v))
+                    stack.append(v)
+
+
+class WorldSnapshot:
+    def __init__(self, level, players):
+        self.level = level
+        self.players = players
+        self.saved_objects = dict(level.objects)
+        self.saved_players = dict(players)
+        self.particle_clouds = list(level.particle_clouds)
+        self.id_count = level.id_count
+        self.random_state = np.random.get_state()
+
+        self.entities = []
+        self.grid = []
+        arrays = []
+        offset = 0
+
+        roots = self.roots()
+        visited = {id(r) for r in roots}
+        stack = list(reversed(roots))
+
+        while stack:
+            entity = stack.pop()
+            values = dict()
+            entity_arrays = []
+            containers = []
+            for name, value in vars(entity).items():
+                if name in TRANSIENT:
+                    continue
+
+                kind = KINDS.get(type(value), VALUE)
+                if kind is VALUE:
+                    values[name] = value
+                    owned = (value, )
+                elif kind is ARRAY:
+                    entity_arrays.append((name, value, offset, offset + value.size))
+                    arrays.append(value.ravel())
+                    offset += value.size
+                    continue
+                elif kind is LIST:
+                    containers.append((name, kind, value, list(value)))
+                    owned = value
+                else:
+                    containers.append((name, kind, value, value.copy()))
+                    owned = value.values() if kind is DICT else value
+
+                if name != 'parent':
+                    for v in owned:
+                        if is_owned(v) and id(v) not in visited:
+                            visited.add(id(v))
+                            stack.append(v)
+
+            if isinstance(entity, Collider) and entity.left is not None:
+                self.grid.append((entity, entity.left, entity.right, entity.bottom, entity.top))
+
+            self.entities.append((entity, values, entity_arrays, containers))
+
+        # every array in the world is copied into one contiguous buffer
+        self.buffer = np.concatenate(arrays).astype(float) if arrays else np.zeros(0)
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes
+
+    def roots(self):
+        level = self.level
+        roots = list(level.objects.values()) + list(self.players.values()) + list(level.goals) + \
+            level.particle_clouds
+        if level.scoreboard:
+            roots.append(level.scoreboard)
+
+        return roots
+
+    def restore(self, colliders):
+        for entity in walk(self.roots()):
+            if isinstance(entity, Collider):
+                entity.clear_occupied_squares(colliders)
+
+        for key, obj in list(self.level.objects.items()):
+            if self.saved_objects.get(key) is not obj:
+                obj.delete()
+
+        self.level.objects.clear()
+        self.level.objects.update(self.saved_objects)
+        self.players.clear()
+        self.players.update(self.saved_players)
+        self.level.particle_clouds = list(self.particle_clouds)
+        self.level.id_count = self.id_count
+
+        buffer = self.buffer
+        for entity, values, arrays, containers in self.entities:
+            attributes = vars(entity)
+            attributes.update(values)
+
+            for name, array, start, stop in arrays:
+                array[...] = buffer[start:stop].reshape(array.shape)
+                attributes[name] = array
+
+            for name, kind, container, saved in containers:
+                if kind is LIST:
+                    container[:] = saved
+                else:
+                    container.clear()
+                    container.update(saved)
+                attributes[name] = container
+
+        for collider, left, right, bottom, top in self.grid:
+            collider.left = left
+            collider.right = right
+            collider.bottom = bottom
+            collider.top = top
+            for i in range(left, right):
+                for j in range(bottom, top):
+                    colliders[i][j].append(collider)
+
+        np.random.set_state(self.random_state)
+
+
+def summary(snapshot):
+    # the saved state with references to other objects replaced by their types, so that two runs can be compared
+    def plain(value):
+        return type(value).__name__ if hasattr(value, '__dict__') else value
+
+    entities = []
+    for entity, values, arrays, containers in snapshot.entities:
+        values = {k: plain(v) for k, v in values.items()}
+        saved = [(n, [plain(v) for v in (c.values() if kind is DICT else c)]) for n, kind, _, c in containers]
+        entities.append((type(entity).__name__, values, [(n, a.shape) for n, a, _, _ in arrays], saved))
+
+    return snapshot.buffer.tolist(), entities, snapshot.id_count
+
+
+if __name__ == '__main__':
+    # steps a level with random inputs, restores a snapshot from halfway and steps again, both runs have to pass
+    # through the same states
+    import os
+    import sys
+    import time
+
+    from pyglet import options
+    options['headless'] = True
+
+    from inputhandler import Controller
+    from level import Level
+    from player import Player
+    from protocol import quantize_input
+    from rollback import Rollback
+    from weapon import Shotgun
+
+    level = Level(sys.argv[1] if len(sys.argv) > 1 else os.path.join('multiplayer', 'circle'))
+    colliders = [[[] for _ in range(int(level.height))] for _ in range(int(level.width))]
+    for obj in level.walls + level.goals + list(level.objects.values()):
+        obj.collider.update_occupied_squares(colliders)
+
+    players = dict()
+    for k in range(2):
+        players[k] = Player([0, 0], -1, k)
+        players[k].team = ['blue', 'red'][k]
+        players[k].set_spawn(level, players)
+
+    # a gun in the hand of each player, shots draw random numbers and add and remove objects
+    for player in players.values():
+        for _ in range(10):
+            player.update(level.gravity, 1 / 60, colliders)
+        gun = Shotgun(player.hand.position.copy())
+        level.add_object(gun)
+        gun.collider.update_occupied_squares(colliders)
+        player.grab_object(colliders)
+    id_count = level.id_count
+
+    rollback = Rollback(level, players, colliders, 0, 1234)
+    rollback.start()
+
+    generator = np.random.RandomState(0)
+    frames = 600
+    for k in players:
+        controller = Controller(-1)
+        for f in range(frames):
+            if f % 15 == 0:
+                controller.left_stick[:] = generator.uniform(-1, 1, 2)
+                controller.right_stick[:] = generator.uniform(-1, 1, 2)
+                controller.left_trigger, controller.right_trigger = generator.rand(2) < [0.05, 0.5]
+            for b in controller.buttons:
+                controller.button_pressed[b] = generator.rand() < 0.05
+                controller.button_down[b] = controller.button_pressed[b] or \
+                    (controller.button_down[b] and generator.rand() < 0.9)
+            rollback.inputs[k][f] = quantize_input(controller.get_data())
+
+    first = []
+    start = time.perf_counter()
+    for f in range(frames):
+        rollback.step()
+        first.append(summary(WorldSnapshot(level, players)))
+    step_time = (time.perf_counter() - start) / frames
+
+    restored = frames // 2
+    rollback.snapshots[restored].restore(colliders)
+    rollback.frame = restored
+    mismatch = None
+    for f in range(restored, frames):
+        rollback.step()
+        if mismatch is None and summary(WorldSnapshot(level, players)) != first[f]:
+            mismatch = f
+
+    print(f'{frames} frames, {level.id_count - id_count} objects added, {1000 * step_time:.2f} ms per step and '
+          f'snapshot, {rollback.snapshots[restored].nbytes} bytes of arrays per snapshot')
+    print(f'restored frame {restored} and stepped again: ' +
+          ('same states' if mismatch is None else f'first difference at frame {mismatch}'))
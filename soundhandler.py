@@ -1,8 +1,16 @@
+import itertools
 import os
 import random
+import time
 
 import pyglet
 
+from assets import AssetDict, submit, record
+
+
+def decode_sound(path):
+    return pyglet.media.load(path, streaming=False)
+
 
 class MusicPlayer(pyglet.media.player.Player):
     def __init__(self):
@@ -22,18 +30,14 @@ class MusicPlayer(pyglet.media.player.Player):
 
 class SoundHandler:
     def __init__(self, option_handler):
-        self.sounds = {}
-        self.music = {}
+        self.sounds = AssetDict(self.load_sound)
+        self.music = AssetDict(self.load_music)
+        self.futures = dict()
 
         path = os.path.join('data', 'sfx')
         for file in os.listdir(path):
             if file.endswith('wav'):
-                self.sounds[file.split('.')[0]] = pyglet.media.load(os.path.join(path, file), streaming=False)
-
-        path = os.path.join('data', 'music')
-        for file in os.listdir(path):
-            if file.endswith('ogg'):
-                self.music[file.split('.')[0]] = pyglet.media.load(os.path.join(path, file))
+                self.futures[file.split('.')[0]] = submit('sounds', decode_sound, os.path.join(path, file))
 
         self.volume = 1.0
         self.music_volume = 1.0
@@ -44,14 +48,27 @@ class SoundHandler:
         tracklist = ['break', 'chaos', 'line', 'scatter', 'steady']
         random.shuffle(tracklist)
         self.set_tracklist(self.music_player, tracklist)
-        self.music_player.on_player_eos = lambda: self.set_tracklist(self.music_player, tracklist)
 
         self.menu_player = MusicPlayer()
         self.set_tracklist(self.menu_player, ['somber'])
-        self.menu_player.on_player_eos = lambda: self.set_tracklist(self.menu_player, ['somber'])
 
         self.set_music_volume(option_handler.music_volume)
 
+    @property
+    def loaded(self):
+        return all(f.done() for f in self.futures.values())
+
+    def load_sound(self, name):
+        if name in self.futures:
+            self.sounds[name] = self.futures.pop(name).result()[0]
+
+    def load_music(self, name):
+        path = os.path.join('data', 'music', name + '.ogg')
+        if os.path.exists(path):
+            start = time.perf_counter()
+            self.music[name] = pyglet.media.load(path)
+            record('music', time.perf_counter() - start)
+
     def set_volume(self, vol):
         self.volume = (vol / 100)**2
 
@@ -61,6 +78,7 @@ class SoundHandler:
         self.menu_player.volume = self.music_volume
 
     def set_tracklist(self, player, tracklist):
-        for track in tracklist:
-            player.queue(self.music[track])
+        # the player takes the next track from the playlist only when the current one ends, so each track is opened
+        # when it starts and the list repeats forever
+        player.queue(self.music[track] for track in itertools.cycle(tracklist))
         player.play()
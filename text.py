@@ -35,6 +35,7 @@ class Text:
         self.layer = layer
         self.visible = True
         self.icons = []
+        self.drawn_state = None
 
         self.parse_icons()
 
@@ -45,6 +46,9 @@ class Text:
         self.string = string
         self.parse_icons()
 
+        # the icons are replaced by spaces, so a new string can look the same as the old one without its icons
+        self.drawn_state = None
+
     def parse_icons(self):
         for i in range(len(self.string)):
             for char in ['A', 'B', 'X', 'Y', 'RT', 'LT', 'R', 'L', 'START']:
@@ -61,8 +65,9 @@ class Text:
 
     def set_visible(self, visible):
         self.visible = visible
-        if self.label:
-            self.label.font_size = visible * self.size
+        self.drawn_state = None
+        if self.label and not visible:
+            self.label.text = ''
 
     def delete(self):
         if self.label:
@@ -72,6 +77,11 @@ class Text:
 
     def draw(self, batch, camera, image_handler):
         string = self.string if self.visible else ''
+        state = (string, self.size, self.color, *self.position)
+        if self.label and state == self.drawn_state and not camera.moved:
+            return
+        self.drawn_state = state
+
         self.label = camera.draw_label(string, self.position, self.visible * self.size, self.font, self.color,
                                        batch=batch, layer=self.layer, label=self.label)
         for icon in self.icons:
@@ -85,13 +95,15 @@ class TitleText(Text):
         self.chromatic_aberration = 0.0
         self.label_red = None
         self.label_cyan = None
+        self.drawn_title_state = None
 
     def set_visible(self, visible):
         super().set_visible(visible)
-        if self.label_red:
-            self.label_red.font_size = visible * self.size
-        if self.label_cyan:
-            self.label_cyan.font_size = visible * self.size
+        self.drawn_title_state = None
+        if self.label_red and not visible:
+            self.label_red.text = ''
+        if self.label_cyan and not visible:
+            self.label_cyan.text = ''
 
     def delete(self):
         super().delete()
@@ -103,6 +115,10 @@ class TitleText(Text):
     def draw(self, batch, camera, image_handler):
         super().draw(batch, camera, image_handler)
         string = self.string if self.visible else ''
+        state = (string, self.size, self.chromatic_aberration, *self.position)
+        if self.label_red and state == self.drawn_title_state and not camera.moved:
+            return
+        self.drawn_title_state = state
 
         r = 0.05 * self.chromatic_aberration * self.size * np.array([1, -1])
         self.label_red = camera.draw_label(string, self.position - r, self.size, self.font, (255, 0, 0),
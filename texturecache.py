@@ -0,0 +1,57 @@
+import hashlib
+import os
+import zlib
+
+import PIL
+
+
+CACHE_PATH = 'cache'
+CACHE_VERSION = 2
+
+asset_hashes = dict()
+
+
+def asset_hash(path):
+    if path not in asset_hashes:
+        h = hashlib.sha1()
+        for file in sorted(os.listdir(path)):
+            if not os.path.isfile(os.path.join(path, file)):
+                continue
+            h.update(file.encode())
+            with open(os.path.join(path, file), 'rb') as f:
+                h.update(f.read())
+        asset_hashes[path] = h.hexdigest()
+
+    return asset_hashes[path]
+
+
+def cache_key(name, data, *asset_paths):
+    # the key changes with any file in the directories the texture is made from
+    h = hashlib.sha1(f'{CACHE_VERSION} {PIL.__version__} {data}'.encode())
+    for path in sorted(set(asset_paths)):
+        h.update(asset_hash(path).encode())
+    return f'{name}_{h.hexdigest()}'
+
+
+def load(key, size):
+    try:
+        with open(os.path.join(CACHE_PATH, key), 'rb') as f:
+            data = zlib.decompress(f.read())
+    except (OSError, zlib.error):
+        return None
+
+    if len(data) != size:
+        return None
+
+    return data
+
+
+def save(key, data):
+    path = os.path.join(CACHE_PATH, key)
+    try:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(zlib.compress(data, 1))
+        os.replace(path + '.tmp', path)
+    except OSError:
+        print(f'Could not write texture cache {path}')
@@ -1,10 +1,9 @@
 import numpy as np
 import pyglet
-from PIL import Image
 
 from gameobject import GameObject, Destroyable
 from collider import Rectangle, Group
-from helpers import basis, normalized
+from helpers import basis, normalized, paste
 from particle import Dust
 from text import Text
 
@@ -62,25 +61,19 @@ class Wall(GameObject):
                     m = 2
 
                 pos = self.position + self.image_position + np.array([x, j - h])
-                decal = image_handler.tiles[self.image_path][n][m]
-                size = [int(1.05 * s) for s in decal.size]
-                decal = decal.resize(size, Image.ANTIALIAS)
-                mask = decal.convert('RGBA')
+                tile, mask, shadow = image_handler.get_tile(self.image_path, n, m)
 
                 if light is not None:
-                    decal = decal.convert('L').point(lambda _: 0, mode='1').convert('RGBA')
-                    decal.putalpha(128)
-
                     shadow_offset = 0.5 * normalized(self.position - light.position)
-                    image.paste(decal, [int(p * 100) for p in pos + shadow_offset], mask)
+                    paste(image, shadow, mask, [int(p * 100) for p in pos + shadow_offset])
                 else:
-                    image.paste(decal, [int(p * 100) for p in pos], mask)
+                    paste(image, tile, mask, [int(p * 100) for p in pos])
 
     def draw(self, batch, camera, image_handler):
         if self.sprite is None:
             width = int(self.collider.width * 100) + 50
             height = int(self.collider.height * 100) + 100
-            image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+            image = np.zeros((height, width, 4), dtype=np.uint8)
 
             pos = self.position.copy()
             self.position = self.collider.half_width + self.collider.half_height + 0.6 * basis(1)
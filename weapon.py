@@ -314,6 +314,8 @@ class Grenade(Destroyable):
                     if particle_type:
                         self.particle_clouds.append(particle_type(obj.position, 5 * r))
 
+            explosion_collider.clear_occupied_squares(colliders)
+
             self.particle_clouds.append(Explosion(self.position))
             self.sounds.add('grenade')
 